@@ -0,0 +1,157 @@
+import json
+import platform
+import random
+import sys
+from optparse import make_option
+from timeit import default_timer
+
+import django
+from django.core.management.base import NoArgsCommand
+from django.db import connection
+
+from test_db import Patcher, data_store
+from music.factories import ArtistFactory
+from music.models import Artist, Fan
+
+
+BACKENDS = ('memory', 'sqlite')
+
+
+class Benchmark(object):
+    """Times the main queryset operations against a populated store.
+
+    Each operation is run `repeat` times against `rows` artists, each with a
+    fan, and the total time recorded. Deletes work through the artists made
+    by the create operation, so the table stays the same size.
+    """
+    def __init__(self, backend, rows, repeat):
+        self.backend = backend
+        self.rows = rows
+        self.repeat = repeat
+        self.random = random.Random(rows)
+        self.created = []
+
+    def populate(self):
+        Artist.objects.bulk_create([Artist(name='Artist %d' % i) for i in range(self.rows)])
+        self.artists = list(Artist.objects.order_by('pk'))
+        Fan.objects.bulk_create([Fan(name='Fan %d' % i, artist=artist) for i, artist in enumerate(self.artists)])
+        self.fans = list(Fan.objects.order_by('pk'))
+
+    def pick(self, objs):
+        return objs[self.random.randrange(len(objs))]
+
+    def time_create(self, i):
+        self.created.append(ArtistFactory(name='New artist %d' % i))
+
+    def time_get(self, i):
+        Artist.objects.get(pk=self.pick(self.artists).pk)
+
+    def time_filter(self, i):
+        list(Artist.objects.filter(name=self.pick(self.artists).name))
+
+    def time_exclude(self, i):
+        Fan.objects.exclude(artist=self.pick(self.artists)).count()
+
+    def time_order_by_slice(self, i):
+        list(Artist.objects.order_by('-name')[:10])
+
+    def time_count(self, i):
+        Artist.objects.filter(name__startswith='Artist 1').count()
+
+    def time_exists(self, i):
+        Artist.objects.filter(name=self.pick(self.artists).name).exists()
+
+    def time_update(self, i):
+        Artist.objects.filter(pk=self.pick(self.artists).pk).update(name='Updated %d' % i)
+
+    def time_delete(self, i):
+        Artist.objects.filter(pk=self.created.pop().pk).delete()
+
+    def time_m2m_add_remove(self, i):
+        fan = self.pick(self.fans)
+        friend = self.pick(self.fans)
+        fan.friends.add(friend)
+        fan.friends.remove(friend)
+
+    def time_reverse_fk(self, i):
+        list(self.pick(self.artists).fan_set.all())
+
+    operations = [
+        'create', 'get', 'filter', 'exclude', 'order_by_slice', 'count', 'exists',
+        'update', 'delete', 'm2m_add_remove', 'reverse_fk',
+    ]
+
+    def run(self):
+        start = default_timer()
+        self.populate()
+        results = [self.result('populate', default_timer() - start, 1)]
+        for operation in self.operations:
+            func = getattr(self, 'time_%s' % operation)
+            start = default_timer()
+            for i in xrange(self.repeat):
+                func(i)
+            results.append(self.result(operation, default_timer() - start, self.repeat))
+        return results
+
+    def result(self, operation, seconds, repeat):
+        return {
+            'backend': self.backend,
+            'rows': self.rows,
+            'operation': operation,
+            'repeat': repeat,
+            'seconds': seconds,
+            'per_operation': seconds / repeat,
+        }
+
+
+class Command(NoArgsCommand):
+    option_list = NoArgsCommand.option_list + (
+        make_option('--sizes', dest='sizes', default='10,1000,100000',
+            help='Comma separated numbers of rows to benchmark at.'),
+        make_option('--repeat', dest='repeat', type='int', default=100,
+            help='How many times to run each operation.'),
+        make_option('--backends', dest='backends', default=','.join(BACKENDS),
+            help='Comma separated backends to benchmark, from "memory" and "sqlite".'),
+        make_option('--output', dest='output', default=None,
+            help='File to write the JSON results to. Defaults to stdout.'),
+    )
+    help = ('Times queryset operations against the in-memory data store and a '
+            'real SQLite database, and writes the results out as JSON.')
+
+    def handle_noargs(self, **options):
+        verbosity = int(options.get('verbosity'))
+        sizes = [int(size) for size in options['sizes'].split(',')]
+        backends = options['backends'].split(',')
+        results = []
+        for backend in backends:
+            for rows in sizes:
+                if verbosity > 1:
+                    sys.stderr.write('Benchmarking %s with %d rows\n' % (backend, rows))
+                results.extend(self.run(backend, rows, options['repeat']))
+        report = {
+            'python': platform.python_version(),
+            'django': django.get_version(),
+            'results': results,
+        }
+        if options['output']:
+            with open(options['output'], 'w') as output:
+                json.dump(report, output, indent=2, sort_keys=True)
+        else:
+            json.dump(report, self.stdout, indent=2, sort_keys=True)
+
+    def run(self, backend, rows, repeat):
+        benchmark = Benchmark(backend, rows, repeat)
+        if backend == 'memory':
+            patcher = Patcher(('music.models',))
+            patcher.start()
+            try:
+                return benchmark.run()
+            finally:
+                patcher.stop()
+                data_store.clear()
+        old_name = connection.settings_dict['NAME']
+        connection.creation.create_test_db(verbosity=0)
+        try:
+            return benchmark.run()
+        finally:
+            connection.creation.destroy_test_db(old_name, verbosity=0)
@@ -21,6 +21,11 @@ class Fan(models.Model):
         return self.name
 
 
+class Gig(models.Model):
+    artist = models.ForeignKey(Artist)
+    when = models.DateField()
+
+
 class Album(models.Model):
     name = models.CharField(max_length=255)
     artist = models.ForeignKey(Artist)
@@ -34,6 +39,9 @@ class Track(models.Model):
     artist = models.ForeignKey(Artist, blank=True, null=True)
     collaborators = models.ManyToManyField(Artist, blank=True, related_name='collaborations')
 
+    class Meta:
+        unique_together = ('album', 'number')
+
     def track_details(self):
         return {
             'number': self.number,
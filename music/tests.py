@@ -1,17 +1,36 @@
+import os
+import shutil
+import StringIO
+import tempfile
+import threading
 import time
 import unittest
+from datetime import date
 
+from django.core.exceptions import FieldError
+from django.db import IntegrityError
+from django.db.models import Avg, Count, Max, Min, Q, Sum
 from django.test import TestCase
 import mock
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
-from test_db import QuerySet, data_store, get_related_queryset, add_items, clear_items, remove_items
+from test_db import (
+    DataStore, MemoryAssertionsMixin, QueryRecorder, QuerySet, Record, ResultCache, SnapshotTestMixin, data_store, plan_cache, get_related_queryset,
+    add_items, clear_items, dump_store, iter_fixture, load_fixture, load_or_populate, load_store, remove_items, restore, snapshot,
+    test_db, use_store,
+)
 from .factories import ArtistFactory, TrackFactory
-from .models import RecordLabel, Artist, Fan, Album, Track
+from .models import RecordLabel, Artist, Fan, Gig, Album, Track
 
 
 cursor_wrapper = mock.Mock()
 cursor_wrapper.side_effect = RuntimeError("No touching the database!")
 no_db_tests = mock.patch("django.db.backends.util.CursorWrapper", cursor_wrapper)
+# Tests of the data store itself, which mean nothing against a real database.
+memory_only = unittest.skipIf(os.environ.get('USE_REAL_DB', '0') != '0', 'USE_REAL_DB is set')
 
 
 correct_details = {
@@ -110,7 +129,7 @@ class MemoryManagerSingleModelTests(TestCase):
 
     def test_create(self):
         artist = Artist.objects.create(name='Bob')
-        self.assertEqual(Artist.objects.get_queryset().query.data_store, [artist])
+        self.assertEqual(Artist.objects.get_queryset().query.data_store.values(), [artist])
         self.assertEqual(artist.pk, 1)
         self.assertEqual(artist.id, 1)
 
@@ -163,6 +182,47 @@ class MemoryManagerSingleModelTests(TestCase):
         artists = Artist.objects.filter(name='Bob').exclude(pk=1)
         self.assertSequenceEqual(artists, [bob2])
 
+    def test_filter_or(self):
+        bob = Artist.objects.create(name='Bob')
+        Artist.objects.create(name='Dave')
+        fred = Artist.objects.create(name='Fred')
+        artists = Artist.objects.filter(Q(name='Bob') | Q(name='Fred'))
+        self.assertSequenceEqual(artists, [bob, fred])
+
+    def test_exclude_multiple_conditions(self):
+        bob = Artist.objects.create(name='Bob')
+        bob2 = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        artists = Artist.objects.exclude(name='Bob', pk=bob2.pk)
+        self.assertSequenceEqual(artists, [bob, dave])
+
+    def test_negated_or(self):
+        Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        Artist.objects.create(name='Fred')
+        artists = Artist.objects.filter(~(Q(name='Bob') | Q(name='Fred')))
+        self.assertSequenceEqual(artists, [dave])
+
+    def test_indexed_set_operations(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        fred = Artist.objects.create(name='Fred')
+        Artist.objects.create(name='Bob')
+        artists = Artist.objects.filter(name__in=['Bob', 'Dave', 'Fred']).exclude(pk__gt=fred.pk).filter(~Q(name='Dave'))
+        self.assertSequenceEqual(artists, [bob, fred])
+        artists = Artist.objects.filter(Q(pk=dave.pk) | ~Q(name__gte='C'))
+        self.assertSequenceEqual(artists, [bob, dave, Artist.objects.get(pk=4)])
+        artists = Artist.objects.filter(Q(name='Fred') | Q(name__contains='av'), pk__lt=fred.pk)
+        self.assertSequenceEqual(artists, [dave])
+
+    def test_plans_reused(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        self.assertSequenceEqual(Artist.objects.filter(name='Bob'), [bob])
+        plans = len(plan_cache)
+        self.assertSequenceEqual(Artist.objects.filter(name='Dave'), [dave])
+        self.assertEqual(len(plan_cache), plans)
+
     def test_filter_exact(self):
         bob = Artist.objects.create(name='Bob')
         Artist.objects.create(name='Bob the second')
@@ -183,6 +243,19 @@ class MemoryManagerSingleModelTests(TestCase):
         self.assertSequenceEqual(Artist.objects.all()[1:], [bob2, bob3])
         self.assertSequenceEqual(Artist.objects.all()[::2], [bob1, bob3])
 
+    def test_count_slice(self):
+        for name in ['Bob1', 'Bob2', 'Bob3']:
+            Artist.objects.create(name=name)
+        self.assertEqual(Artist.objects.all()[1:].count(), 2)
+        self.assertEqual(Artist.objects.all()[:2].count(), 2)
+        self.assertEqual(Artist.objects.filter(name__contains='Bob')[2:5].count(), 1)
+
+    def test_iterator(self):
+        bob = Artist.objects.create(name='Bob')
+        Artist.objects.create(name='Dave')
+        iterator = Artist.objects.order_by('name').iterator()
+        self.assertTrue(next(iterator) is bob)
+
     def test_get_or_create(self):
         artist, created = Artist.objects.get_or_create(name='Bob')
         self.assertTrue(created)
@@ -195,6 +268,59 @@ class MemoryManagerSingleModelTests(TestCase):
         Artist.objects.all().delete()
         self.assertEqual(Artist.objects.count(), 0)
 
+    def test_create_after_delete(self):
+        bob = Artist.objects.create(name='Bob')
+        Artist.objects.create(name='Dave')
+        Artist.objects.filter(pk=bob.pk).delete()
+        fred = Artist.objects.create(name='Fred')
+        self.assertEqual(fred.pk, 3)
+        self.assertSequenceEqual([a.name for a in Artist.objects.all()], ['Dave', 'Fred'])
+
+    def test_bulk_create(self):
+        Artist.objects.create(name='Bob')
+        self.assertSequenceEqual(Artist.objects.filter(name__gte='C'), [])
+        artists = Artist.objects.bulk_create([Artist(name='Fred'), Artist(pk=5, name='Dave'), Artist(name='Carl')])
+        self.assertEqual([artist.pk for artist in artists], [6, 5, 7])
+        self.assertSequenceEqual(Artist.objects.filter(name__gte='C').order_by('name'), [artists[2], artists[1], artists[0]])
+        self.assertSequenceEqual(Artist.objects.filter(name='Dave'), [artists[1]])
+        self.assertEqual(Artist.objects.create(name='Eve').pk, 8)
+
+    def test_in_bulk(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        self.assertEqual(Artist.objects.in_bulk([bob.pk, '2', 3]), {1: bob, 2: dave})
+        self.assertEqual(Artist.objects.filter(name='Dave').in_bulk([1, 2]), {2: dave})
+        self.assertEqual(Artist.objects.in_bulk([]), {})
+
+    def test_batched_update(self):
+        Artist.objects.bulk_create([Artist(name=name) for name in ('Bob', 'Carl', 'Dave', 'Eve')])
+        self.assertEqual(Artist.objects.filter(name__lt='D').count(), 2)
+        self.assertEqual(Artist.objects.filter(name__gte='C').update(name='Al'), 3)
+        self.assertSequenceEqual([a.pk for a in Artist.objects.filter(name__lt='B')], [2, 3, 4])
+        self.assertSequenceEqual([a.pk for a in Artist.objects.filter(name='Al')], [2, 3, 4])
+
+    def test_chained_querysets_independent(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        artists = Artist.objects.all()
+        not_bob = artists.exclude(name='Bob')
+        self.assertSequenceEqual(not_bob.filter(name='Bob'), [])
+        self.assertSequenceEqual(not_bob, [dave])
+        self.assertSequenceEqual(artists.order_by('-name')[:1], [dave])
+        self.assertSequenceEqual(artists, [bob, dave])
+        self.assertEqual(artists.annotate(tracks=Count('track')).count(), 2)
+        self.assertFalse(hasattr(artists[0], 'tracks'))
+
+    def test_pk_clash(self):
+        bob = Artist.objects.create(name='Bob')
+        with self.assertRaises(IntegrityError):
+            Artist.objects.create(pk=bob.pk, name='Dave')
+        with self.assertRaises(IntegrityError):
+            Artist.objects.bulk_create([Artist(name='Carl'), Artist(pk=5, name='Dave'), Artist(pk=5, name='Eve')])
+        self.assertSequenceEqual(Artist.objects.all(), [bob])
+        Artist.objects.filter(pk=bob.pk).delete()
+        self.assertGreater(Artist.objects.create(name='Dave').pk, bob.pk)
+
     def test_delete_with_filter(self):
         Artist.objects.create(name='Bob')
         Artist.objects.create(name='Dave')
@@ -214,6 +340,11 @@ class MemoryManagerSingleModelTests(TestCase):
     def test_none(self):
         self.assertSequenceEqual(Artist.objects.none(), [])
 
+    def test_none_with_data(self):
+        Artist.objects.create(name='Bob')
+        self.assertSequenceEqual(Artist.objects.none(), [])
+        self.assertFalse(Artist.objects.none().exists())
+
     def test_order_by(self):
         bob = Artist.objects.create(name='Bob')
         adam = Artist.objects.create(name='Adam')
@@ -229,6 +360,16 @@ class MemoryManagerSingleModelTests(TestCase):
         ordered = Artist.objects.order_by('name', '-pk')
         self.assertSequenceEqual(ordered, [adam, bob2, bob])
 
+    def test_order_by_descending_with_slice(self):
+        bob = Artist.objects.create(name='Bob')
+        adam = Artist.objects.create(name='Adam')
+        bob2 = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        self.assertSequenceEqual(Artist.objects.order_by('-name')[:3], [dave, bob, bob2])
+        self.assertSequenceEqual(Artist.objects.order_by('-name')[1:3], [bob, bob2])
+        self.assertSequenceEqual(Artist.objects.order_by('name', '-pk')[:2], [adam, bob2])
+        self.assertSequenceEqual(Artist.objects.order_by('-name', 'pk')[1:], [bob, bob2, adam])
+
     def test_contains_lookup(self):
         bob = Artist.objects.create(name='Bob')
         bobby = Artist.objects.create(name='Bobby')
@@ -241,6 +382,41 @@ class MemoryManagerSingleModelTests(TestCase):
         Artist.objects.create(name='Adam')
         self.assertSequenceEqual(Artist.objects.filter(name__in=['Bob', 'Bobby', 'Fred']), [bob, bobby])
 
+    def test_comparison_lookups(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        fred = Artist.objects.create(name='Fred')
+        self.assertSequenceEqual(Artist.objects.filter(pk__gt=bob.pk), [dave, fred])
+        self.assertSequenceEqual(Artist.objects.filter(pk__gte=dave.pk), [dave, fred])
+        self.assertSequenceEqual(Artist.objects.filter(pk__lt=dave.pk), [bob])
+        self.assertSequenceEqual(Artist.objects.filter(pk__lte=dave.pk), [bob, dave])
+        self.assertSequenceEqual(Artist.objects.filter(name__range=('Bz', 'Fred')), [dave, fred])
+        self.assertSequenceEqual(Artist.objects.exclude(name__gt='Dave'), [bob, dave])
+
+    def test_range_lookup_after_save(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        self.assertSequenceEqual(Artist.objects.filter(name__range=('A', 'C')), [bob])
+        dave.name = 'Adam'
+        dave.save()
+        self.assertSequenceEqual(Artist.objects.filter(name__range=('A', 'C')), [bob, dave])
+
+    def test_startswith_lookup(self):
+        bob = Artist.objects.create(name='Bob')
+        bobby = Artist.objects.create(name='Bobby')
+        Artist.objects.create(name='Adam')
+        self.assertSequenceEqual(Artist.objects.filter(name__startswith='Bob'), [bob, bobby])
+        self.assertSequenceEqual(Artist.objects.filter(name__istartswith='bobb'), [bobby])
+        for i in range(9):
+            Artist.objects.create(name='Artist %d' % i)
+        self.assertSequenceEqual([a.pk for a in Artist.objects.filter(pk__startswith='1')], [1, 10, 11, 12])
+        self.assertSequenceEqual([a.pk for a in Artist.objects.filter(pk__gt=2, pk__endswith=2)], [12])
+
+    def test_isnull_lookup(self):
+        bob = Artist.objects.create(name='Bob')
+        self.assertSequenceEqual(Artist.objects.filter(name__isnull=False), [bob])
+        self.assertSequenceEqual(Artist.objects.filter(name__isnull=True), [])
+
     def test_iexact_lookup(self):
         bob = Artist.objects.create(name='Bob')
         Artist.objects.create(name='Adam')
@@ -258,6 +434,26 @@ class MemoryManagerSingleModelTests(TestCase):
         bob.save()
         self.assertSequenceEqual(Artist.objects.all(), [bob])
 
+    def test_indexed_lookup_after_save(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        self.assertSequenceEqual(Artist.objects.filter(name='Bob'), [bob])
+        bob.name = 'Dave'
+        bob.save()
+        self.assertSequenceEqual(Artist.objects.filter(name='Bob'), [])
+        self.assertSequenceEqual(Artist.objects.filter(name='Dave'), [bob, dave])
+
+    def test_indexed_lookup_after_delete(self):
+        bob = Artist.objects.create(name='Bob')
+        self.assertEqual(Artist.objects.get(pk=bob.pk), bob)
+        Artist.objects.filter(name='Bob').delete()
+        self.assertSequenceEqual(Artist.objects.filter(pk=bob.pk), [])
+
+    def test_indexed_in_lookup_keeps_storage_order(self):
+        bob = Artist.objects.create(name='Bob')
+        bobby = Artist.objects.create(name='Bobby')
+        self.assertSequenceEqual(Artist.objects.filter(pk__in=[bobby.pk, bob.pk]), [bob, bobby])
+
     @unittest.expectedFailure
     def test_save_new_object(self):
         # This is difficult to implement - it never hits the queryset.
@@ -317,6 +513,20 @@ class MemoryManagerFKTests(TestCase):
         Fan.objects.create(name='Lottie', artist=dave)
         self.assertSequenceEqual(Fan.objects.filter(artist__name='Bob'), [annie])
 
+    def test_lookups_across_many_objects(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        annie = Fan.objects.create(name='Annie', artist=bob)
+        lottie = Fan.objects.create(name='Lottie', artist=bob)
+        annie.friends.add(lottie)
+        self.assertSequenceEqual(Artist.objects.filter(fan__name='Lottie'), [bob])
+        self.assertSequenceEqual(Artist.objects.filter(fan__isnull=True), [dave])
+        self.assertSequenceEqual(Fan.objects.filter(friends__name='Lottie'), [annie])
+        self.assertSequenceEqual(Fan.objects.filter(friends__isnull=True), [lottie])
+        self.assertSequenceEqual(Fan.objects.filter(fan__artist__name='Bob'), [lottie])
+        with self.assertRaises(FieldError):
+            list(Fan.objects.filter(artist__fans__name='Annie'))
+
     def test_m2m_get_empty(self):
         bob = Artist.objects.create(name='Bob')
         annie = Fan.objects.create(name='Annie', artist=bob)
@@ -354,3 +564,740 @@ class MemoryManagerFKTests(TestCase):
         annie.friends.remove(lottie)
         self.assertSequenceEqual(annie.friends.all(), [])
 
+
+
+@no_db_tests
+@mock.patch.object(Artist.objects, 'get_queryset', lambda: QuerySet(Artist))
+@mock.patch.object(Fan.objects, 'get_queryset', lambda: QuerySet(Fan))
+class SnapshotTests(SnapshotTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.bob = QuerySet(Artist).create(name='Bob')
+        cls.dave = QuerySet(Artist).create(name='Dave')
+
+    def test_changes(self):
+        self.bob.name = 'Robert'
+        self.bob.save()
+        Artist.objects.filter(pk=self.dave.pk).delete()
+        Artist.objects.create(name='Fred')
+        self.assertSequenceEqual([a.name for a in Artist.objects.all()], ['Robert', 'Fred'])
+
+    def test_untouched(self):
+        self.assertSequenceEqual(Artist.objects.all(), [self.bob, self.dave])
+        self.assertEqual(self.bob.name, 'Bob')
+        self.assertSequenceEqual(Artist.objects.filter(name='Bob'), [self.bob])
+        self.assertEqual(Artist.objects.create(name='Fred').pk, 3)
+
+    def test_nested_snapshot(self):
+        Artist.objects.create(name='Fred')
+        inner = snapshot()
+        Fan.objects.create(name='Annie', artist=self.bob)
+        self.assertEqual(Fan.objects.count(), 1)
+        restore(inner)
+        self.assertEqual(Fan.objects.count(), 0)
+        self.assertEqual(Artist.objects.count(), 3)
+
+    def test_nested_snapshot_restored(self):
+        self.assertEqual(Artist.objects.count(), 2)
+
+
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class DecoratorTests(SnapshotTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.bob = Artist.objects.create(name='Bob')
+
+    def test_track_details(self):
+        label = RecordLabel.objects.create(name='Circus Music')
+        artist = Artist.objects.create(name='Freddy the Clown')
+        album = Album.objects.create(name='All time circus classics', label=label, artist=artist)
+        track = Track.objects.create(number=1, name='Tears of a Clown', album=album)
+        other_artist = Artist.objects.create(name='Buttercup')
+        track.collaborators.add(other_artist)
+        with self.assertNumQueries(0):
+            self.assertEqual(track.track_details(), correct_details)
+
+    def test_reverse_foreign_key(self):
+        annie = Fan.objects.create(name='Annie', artist=self.bob)
+        self.assertSequenceEqual(self.bob.fan_set.all(), [annie])
+        self.assertEqual(annie.artist, self.bob)
+
+    def test_m2m(self):
+        annie = Fan.objects.create(name='Annie', artist=self.bob)
+        lottie = Fan.objects.create(name='Lottie', artist=self.bob)
+        annie.friends.add(lottie)
+        self.assertSequenceEqual(annie.friends.all(), [lottie])
+        annie.friends.clear()
+        self.assertSequenceEqual(annie.friends.all(), [])
+
+    def test_m2m_reverse(self):
+        annie = Fan.objects.create(name='Annie', artist=self.bob)
+        lottie = Fan.objects.create(name='Lottie', artist=self.bob)
+        annie.friends.add(lottie)
+        self.assertSequenceEqual(lottie.fan_set.all(), [annie])
+        lottie.fan_set.remove(annie)
+        self.assertSequenceEqual(annie.friends.all(), [])
+
+    def test_m2m_reverse_clear(self):
+        label = RecordLabel.objects.create(name='Circus Music')
+        album = Album.objects.create(name='Classics', label=label, artist=self.bob)
+        first = Track.objects.create(number=1, name='First', album=album)
+        second = Track.objects.create(number=2, name='Second', album=album)
+        self.bob.collaborations.add(first, second)
+        self.assertSequenceEqual(first.collaborators.all(), [self.bob])
+        self.assertSequenceEqual(self.bob.collaborations.all(), [first, second])
+        self.bob.collaborations.clear()
+        self.assertSequenceEqual(second.collaborators.all(), [])
+
+    def test_m2m_filter(self):
+        label = RecordLabel.objects.create(name='Circus Music')
+        album = Album.objects.create(name='Classics', label=label, artist=self.bob)
+        first = Track.objects.create(number=1, name='First', album=album)
+        Track.objects.create(number=2, name='Second', album=album)
+        dave = Artist.objects.create(name='Dave')
+        first.collaborators.add(self.bob, dave)
+        self.assertSequenceEqual(Track.objects.filter(collaborators=dave), [first])
+        self.assertSequenceEqual(Track.objects.filter(collaborators__pk__in=[dave.pk]), [first])
+        self.assertSequenceEqual(Artist.objects.filter(collaborations=first), [self.bob, dave])
+        self.assertSequenceEqual(Track.objects.exclude(collaborators=dave).filter(number=1), [])
+
+    def test_m2m_delete(self):
+        label = RecordLabel.objects.create(name='Circus Music')
+        album = Album.objects.create(name='Classics', label=label, artist=self.bob)
+        first = Track.objects.create(number=1, name='First', album=album)
+        second = Track.objects.create(number=2, name='Second', album=album)
+        dave = Artist.objects.create(name='Dave')
+        first.collaborators.add(self.bob, dave)
+        second.collaborators.add(self.bob)
+        Artist.objects.filter(pk=dave.pk).delete()
+        self.assertSequenceEqual(first.collaborators.all(), [self.bob])
+        self.assertSequenceEqual(Artist.objects.filter(collaborations=first), [self.bob])
+        self.assertEqual(Artist.objects.filter(collaborations=first).count(), 1)
+        Track.objects.filter(pk=first.pk).delete()
+        self.assertSequenceEqual(self.bob.collaborations.all(), [second])
+        self.assertSequenceEqual(Track.objects.filter(collaborators=self.bob), [second])
+
+    def test_date_transforms(self):
+        first = Gig.objects.create(artist=self.bob, when=date(2014, 3, 1))
+        second = Gig.objects.create(artist=self.bob, when=date(2015, 3, 8))
+        self.assertSequenceEqual(Gig.objects.filter(when__year=2014), [first])
+        self.assertSequenceEqual(Gig.objects.filter(when__month=3), [first, second])
+        self.assertSequenceEqual(Gig.objects.filter(when__year__gte=2015, when__day=8), [second])
+        self.assertSequenceEqual(Gig.objects.filter(when__week_day=1), [second])
+        self.assertSequenceEqual(Artist.objects.filter(gig__when__year=2015), [self.bob])
+
+    def test_m2m_restored(self):
+        self.assertSequenceEqual(Artist.objects.filter(collaborations__pk__in=[1, 2]), [])
+
+    def test_patches_removed(self):
+        patched = Artist.objects.get_queryset
+
+        @test_db('music.models')
+        def inner():
+            return Artist.objects.get_queryset
+
+        self.assertTrue(inner() is patched)
+        self.assertTrue(Artist.objects.get_queryset is patched)
+
+    def test_use_real_db(self):
+        def func():
+            pass
+        with mock.patch.dict(os.environ, {'USE_REAL_DB': '1'}):
+            self.assertTrue(test_db('music.models')(func) is func)
+
+
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class MemoryAssertionsTests(MemoryAssertionsMixin, SnapshotTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.artists = [Artist.objects.create(name='Artist %d' % i) for i in range(20)]
+        cls.fans = [Fan.objects.create(name='Fan %d' % i, artist_id=cls.artists[i].pk) for i in range(2)]
+
+    def test_indexed_get_scans_one_row(self):
+        with self.assertMaxRowsScanned(1):
+            Artist.objects.get(pk=5)
+        self.assertMaxRowsScanned(1, Artist.objects.get, name='Artist 7')
+
+    def test_full_scan_caught(self):
+        with self.assertRaises(AssertionError):
+            with self.assertMaxRowsScanned(1):
+                list(Artist.objects.filter(name__contains='7'))
+
+    def test_reverse_foreign_key_indexed(self):
+        first, second = self.artists[:2]
+        with self.assertMaxRowsScanned(2):
+            self.assertSequenceEqual(first.fan_set.all(), [self.fans[0]])
+            self.assertSequenceEqual(Fan.objects.filter(artist__pk=second.pk), [self.fans[1]])
+
+    def test_reverse_foreign_key_after_save(self):
+        first, second = self.artists[:2]
+        fan = self.fans[0]
+        fan.artist = second
+        fan.save()
+        with self.assertMaxRowsScanned(2):
+            self.assertSequenceEqual(first.fan_set.all(), [])
+            self.assertSequenceEqual(second.fan_set.all(), self.fans)
+            self.assertSequenceEqual(Fan.objects.filter(artist__id=first.pk), [])
+
+    def test_select_related(self):
+        label = RecordLabel.objects.create(name='Circus Music')
+        album = Album.objects.create(name='All time circus classics', label=label, artist=self.artists[0])
+        Track.objects.create(number=1, name='Tears of a Clown', album_id=album.pk)
+        Track.objects.create(number=2, name='Send in the Clowns', album_id=album.pk)
+        with self.assertNumMemoryQueries(1):
+            tracks = list(Track.objects.select_related('album__label', 'artist'))
+            self.assertEqual([track.album.label for track in tracks], [label, label])
+            self.assertEqual([track.artist for track in tracks], [None, None])
+
+    def test_prefetch_related(self):
+        label = RecordLabel.objects.create(name='Circus Music')
+        album = Album.objects.create(name='All time circus classics', label=label, artist=self.artists[0])
+        tracks = [
+            Track.objects.create(number=i, name='Track %d' % i, album_id=album.pk) for i in range(3)
+        ]
+        tracks[0].collaborators.add(self.artists[1], self.artists[2])
+        tracks[2].collaborators.add(self.artists[1])
+        with self.assertNumMemoryQueries(1):
+            prefetched = list(Track.objects.prefetch_related('collaborators__fan_set'))
+            self.assertEqual(
+                [list(track.collaborators.all()) for track in prefetched],
+                [self.artists[1:3], [], [self.artists[1]]],
+            )
+            self.assertSequenceEqual(prefetched[0].collaborators.all()[0].fan_set.all(), [self.fans[1]])
+
+    def test_prefetch_related_get(self):
+        artist = Artist.objects.prefetch_related('fan_set').get(pk=self.artists[0].pk)
+        with self.assertNumMemoryQueries(0):
+            self.assertSequenceEqual(artist.fan_set.all(), [self.fans[0]])
+
+    def test_prefetched_rows_kept_current(self):
+        artist = Artist.objects.prefetch_related('fan_set')[0]
+        self.assertSequenceEqual(artist.fan_set.all(), [self.fans[0]])
+        annie = Fan.objects.create(name='Annie', artist_id=artist.pk)
+        self.assertSequenceEqual(artist.fan_set.all(), [self.fans[0], annie])
+
+    def test_aggregate(self):
+        Fan.objects.create(name='Annie', artist_id=self.artists[0].pk)
+        with self.assertNumMemoryQueries(1):
+            self.assertEqual(Artist.objects.filter(pk__lte=3).aggregate(
+                Count('fan'), Max('pk'), fans=Count('fan__artist', distinct=True), mean=Avg('pk'), total=Sum('fan__pk'),
+            ), {'fan__count': 3, 'pk__max': 3, 'fans': 2, 'mean': 2.0, 'total': 6})
+        self.assertEqual(Fan.objects.filter(name='Nobody').aggregate(Count('pk'), Min('name')),
+                         {'pk__count': 0, 'name__min': None})
+
+    def test_annotate(self):
+        Fan.objects.create(name='Annie', artist_id=self.artists[1].pk)
+        artists = Artist.objects.annotate(fans=Count('fan')).filter(fans__gt=0).order_by('-fans')
+        self.assertEqual([(artist.name, artist.fans) for artist in artists], [('Artist 1', 2), ('Artist 0', 1)])
+        self.assertEqual(Artist.objects.annotate(fans=Count('fan')).aggregate(most=Max('fans')), {'most': 2})
+        # The annotations don't stick to the objects kept in the store.
+        self.assertFalse(hasattr(Artist.objects.get(pk=self.artists[1].pk), 'fans'))
+
+    def test_values(self):
+        self.assertSequenceEqual(
+            Fan.objects.values(), [
+                {'id': fan.pk, 'name': fan.name, 'artist_id': fan.artist_id} for fan in self.fans
+            ])
+        self.assertSequenceEqual(
+            Fan.objects.order_by('-name').values('name', 'artist__name'), [
+                {'name': 'Fan 1', 'artist__name': 'Artist 1'},
+                {'name': 'Fan 0', 'artist__name': 'Artist 0'},
+            ])
+        self.assertEqual(Fan.objects.values('artist').get(name='Fan 1'), {'artist': self.artists[1].pk})
+
+    def test_values_list(self):
+        self.assertSequenceEqual(Artist.objects.filter(pk__lte=2).values_list('pk', 'name'), [(1, 'Artist 0'), (2, 'Artist 1')])
+        self.assertSequenceEqual(Artist.objects.filter(pk__lte=2).values_list('name'), [('Artist 0',), ('Artist 1',)])
+        self.assertSequenceEqual(Artist.objects.filter(name='Artist 3').values_list('id', flat=True), [4])
+        self.assertSequenceEqual(Fan.objects.values_list('artist__fan__name', flat=True), ['Fan 0', 'Fan 1'])
+        with self.assertRaises(TypeError):
+            Artist.objects.values_list('pk', 'name', flat=True)
+
+    def test_values_distinct(self):
+        Fan.objects.create(name='Fan 0', artist_id=self.artists[1].pk)
+        names = Fan.objects.order_by('name').values_list('name', flat=True).distinct()
+        self.assertSequenceEqual(names, ['Fan 0', 'Fan 1'])
+        self.assertEqual(Fan.objects.values('name').distinct().count(), 2)
+        self.assertSequenceEqual(Fan.objects.order_by('-name').values_list('name', flat=True).distinct()[:1], ['Fan 1'])
+
+    def test_values_annotate(self):
+        Fan.objects.create(name='Annie', artist_id=self.artists[1].pk)
+        with self.assertNumMemoryQueries(1):
+            self.assertSequenceEqual(
+                Fan.objects.values('artist').annotate(fans=Count('pk')).order_by('-fans'), [
+                    {'artist': self.artists[1].pk, 'fans': 2},
+                    {'artist': self.artists[0].pk, 'fans': 1},
+                ])
+        self.assertSequenceEqual(
+            Artist.objects.annotate(fans=Count('fan')).filter(fans=1).values_list('name', 'fans'), [('Artist 0', 1)])
+
+    def test_result_cache(self):
+        with ResultCache() as cache:
+            with self.assertNumMemoryQueries(2):
+                for i in range(3):
+                    self.assertEqual(Artist.objects.filter(name__startswith='Artist 1').count(), 11)
+                    self.assertSequenceEqual(Artist.objects.filter(pk__in=[1, 2]), self.artists[:2])
+            self.assertEqual((cache.hits, cache.misses), (4, 2))
+            Artist.objects.create(name='Artist 100')
+            self.assertEqual(Artist.objects.filter(name__startswith='Artist 1').count(), 12)
+            self.assertEqual(cache.misses, 3)
+
+    def test_result_cache_invalidated_by_m2m(self):
+        annie, lottie = self.fans
+        with ResultCache() as cache:
+            self.assertSequenceEqual(annie.friends.all(), [])
+            annie.friends.add(lottie)
+            self.assertSequenceEqual(annie.friends.all(), [lottie])
+            self.assertSequenceEqual(annie.friends.all(), [lottie])
+            self.assertEqual((cache.hits, cache.misses), (1, 2))
+
+    def test_result_cache_ordered_across_relation(self):
+        first, second = self.fans
+        with ResultCache():
+            self.assertSequenceEqual(Fan.objects.order_by('artist__name'), [first, second])
+            artist = Artist.objects.get(pk=first.artist_id)
+            artist.name = 'Renamed'
+            artist.save()
+            self.assertSequenceEqual(Fan.objects.order_by('artist__name'), [second, first])
+
+    def test_result_cache_bounded(self):
+        with ResultCache(maxsize=2) as cache:
+            for pk in (1, 2, 3, 1):
+                list(Artist.objects.filter(pk=pk))
+        self.assertEqual((cache.hits, cache.misses, len(cache.results)), (0, 4, 2))
+
+    def test_clone_reuses_candidates(self):
+        artists = Artist.objects.filter(pk__lte=10)
+        self.assertEqual(len(artists), 10)
+        with QueryRecorder() as recorder:
+            self.assertSequenceEqual(artists.filter(name__startswith='Artist 1'), [self.artists[1]])
+        self.assertEqual(recorder.total('index_hits'), 1)
+        Artist.objects.filter(pk=2).update(name='Renamed')
+        with QueryRecorder() as recorder:
+            self.assertSequenceEqual(artists.filter(name__startswith='Artist 1'), [])
+        self.assertEqual(recorder.total('index_hits'), 2)
+
+    def test_num_queries(self):
+        with self.assertNumMemoryQueries(3):
+            for fan in Fan.objects.all():
+                fan.artist.name
+
+    def test_recorder(self):
+        with QueryRecorder() as recorder:
+            Artist.objects.create(name='Bob')
+            Artist.objects.filter(name='Bob').update(name='Dave')
+            Artist.objects.filter(pk__lt=5).delete()
+            Artist.objects.order_by('-name')[:2].exists()
+        self.assertEqual(recorder.total('creates'), 1)
+        self.assertEqual(recorder.total('updates'), 1)
+        self.assertEqual(recorder.total('deletes', Artist), 4)
+        self.assertEqual(recorder.total('executes'), 3)
+        self.assertEqual(recorder.total('sorts'), 1)
+        self.assertEqual(recorder.total('index_hits'), 2)
+        self.assertEqual(recorder.total('returned'), 6)
+
+
+@memory_only
+class JoinedAggregateTests(TestCase):
+    """Aggregates over relations which have been filtered on, checked against SQL."""
+    def populate(self):
+        bob = Artist.objects.create(name='Bob')
+        dave = Artist.objects.create(name='Dave')
+        Fan.objects.create(name='A', artist=bob)
+        Fan.objects.create(name='B', artist=bob)
+        Fan.objects.create(name='A', artist=dave)
+
+    def results(self):
+        self.populate()
+        filtered = Artist.objects.filter(fan__name='A')
+        return (
+            [(artist.name, artist.n) for artist in filtered.annotate(n=Count('fan')).order_by('name')],
+            filtered.aggregate(Count('fan')),
+            filtered.filter(name='Bob').aggregate(Count('fan')),
+            [(artist.name, artist.n) for artist in Artist.objects.annotate(n=Count('fan')).filter(fan__name='A')],
+            [(artist.name, artist.n) for artist in Artist.objects.exclude(fan__name='B').annotate(n=Count('fan'))],
+        )
+
+    def test_matches_sql(self):
+        expected = self.results()
+        self.assertEqual(expected[:3], ([('Bob', 1), ('Dave', 1)], {'fan__count': 2}, {'fan__count': 1}))
+        with use_store(DataStore()):
+            self.assertEqual(no_db_tests(test_db('music.models')(self.results))(), expected)
+
+    @no_db_tests
+    @test_db('music.models')
+    def test_ambiguous_join(self):
+        with use_store(DataStore()):
+            self.populate()
+            with self.assertRaises(NotImplementedError):
+                Artist.objects.filter(fan__name='A').filter(fan__name='B').aggregate(Count('fan'))
+            with self.assertRaises(NotImplementedError):
+                Artist.objects.filter(Q(fan__name='A') | Q(name='Dave')).aggregate(Count('fan'))
+
+
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class DataStoreTests(TestCase):
+    def tearDown(self):
+        data_store.clear()
+
+    def run_threads(self, target, count=4):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+    def test_use_store(self):
+        Artist.objects.create(name='Bob')
+        with use_store(DataStore()) as store:
+            self.assertEqual(Artist.objects.count(), 0)
+            dave = Artist.objects.create(name='Dave')
+            self.assertEqual(dave.pk, 1)
+            self.assertEqual(data_store[Artist].values(), [dave])
+        self.assertEqual(store[Artist].values(), [dave])
+        self.assertSequenceEqual([a.name for a in Artist.objects.all()], ['Bob'])
+
+    def test_isolated_threads(self):
+        counts = {}
+
+        def shard(i):
+            with use_store(DataStore()):
+                with QueryRecorder() as recorder:
+                    for j in range(50):
+                        Artist.objects.create(name='Artist %d' % j)
+                    counts[i] = Artist.objects.count(), recorder.total('creates')
+
+        self.run_threads(shard)
+        self.assertEqual(counts, dict((i, (50, 50)) for i in range(4)))
+        self.assertEqual(Artist.objects.count(), 0)
+
+    def test_shared_store(self):
+        def writer(i):
+            for j in range(100):
+                Artist.objects.create(name='Artist %d' % i)
+
+        self.run_threads(writer)
+        self.assertEqual(Artist.objects.count(), 400)
+        self.assertEqual(len(set(artist.pk for artist in Artist.objects.all())), 400)
+        self.assertEqual(Artist.objects.filter(name='Artist 2').count(), 100)
+
+    def test_shared_store_reads(self):
+        errors = []
+
+        def worker(i):
+            try:
+                for j in range(200):
+                    if i % 2:
+                        Artist.objects.create(name='Artist %d' % j)
+                    else:
+                        list(Artist.objects.all())
+                        list(Artist.objects.exclude(pk=1))
+                        list(Artist.objects.filter(pk__in=range(100)))
+            except Exception as error:
+                errors.append(error)
+
+        self.run_threads(worker)
+        self.assertEqual(errors, [])
+        self.assertEqual(Artist.objects.count(), 400)
+
+
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class UniqueConstraintTests(SnapshotTestMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        label = RecordLabel.objects.create(name='Circus Music')
+        artist = Artist.objects.create(name='Bob')
+        cls.album = Album.objects.create(name='All time circus classics', label=label, artist=artist)
+        cls.first = Track.objects.create(number=1, name='First', album=cls.album)
+        cls.second = Track.objects.create(number=2, name='Second', album=cls.album)
+
+    def test_create(self):
+        with self.assertRaises(IntegrityError):
+            Track.objects.create(number=1, name='Again', album=self.album)
+        with self.assertRaises(IntegrityError):
+            Track.objects.bulk_create([
+                Track(number=3, name='Third', album=self.album), Track(number=3, name='Also third', album=self.album),
+            ])
+        self.assertEqual(Track.objects.count(), 2)
+        Track.objects.bulk_create([Track(number=3, name='Third', album=self.album)])
+        self.assertEqual(Track.objects.filter(album=self.album, number=3).count(), 1)
+
+    def test_update(self):
+        with self.assertRaises(IntegrityError):
+            Track.objects.filter(number=2).update(number=1)
+        with self.assertRaises(IntegrityError):
+            Track.objects.update(number=5)
+        self.assertSequenceEqual([track.number for track in Track.objects.order_by('pk')], [1, 2])
+        self.assertSequenceEqual(Track.objects.filter(number=2), [self.second])
+        Track.objects.filter(number=2).update(number=5, name='Fifth')
+        Track.objects.filter(number=1).update(number=2)
+        self.assertSequenceEqual([track.number for track in Track.objects.order_by('pk')], [2, 5])
+
+    def test_save_changed_pk(self):
+        track = Track.objects.get(number=2)
+        track.pk = 10
+        track.save()
+        self.assertEqual(Track.objects.get(number=2).pk, 10)
+        self.assertSequenceEqual(Track.objects.filter(pk=2), [])
+        self.assertEqual(Track.objects.get(pk=10).number, 2)
+        self.assertEqual(data_store[Track].keys(), [self.first.pk, 10])
+
+    def test_save_changed_pk_turned_away(self):
+        track = Track.objects.get(number=2)
+        track.pk = 10
+        track.number = 1
+        with self.assertRaises(IntegrityError):
+            track.save()
+        self.assertEqual((track.pk, track.number), (2, 2))
+        self.assertEqual(data_store[Track].keys(), [self.first.pk, 2])
+        self.assertSequenceEqual(Track.objects.filter(pk=2), [track])
+        self.assertSequenceEqual(Track.objects.filter(pk=10), [])
+
+    def test_save(self):
+        track = Track.objects.get(number=2)
+        track.number = 1
+        with self.assertRaises(IntegrityError):
+            track.save()
+        self.assertSequenceEqual(Track.objects.filter(number=1), [self.first])
+        scanned = Track.objects.filter(name__contains='').order_by('pk')
+        self.assertEqual([track.number for track in scanned], [1, 2])
+        self.assertSequenceEqual(Track.objects.filter(album=self.album, number=2), [self.second])
+        self.assertEqual(Track.objects.get(pk=self.second.pk).number, 2)
+        track.number = 3
+        track.save()
+        self.assertSequenceEqual(Track.objects.filter(album=self.album, number=3), [self.second])
+
+
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class CompactStoreTests(MemoryAssertionsMixin, TestCase):
+    def setUp(self):
+        self.store = DataStore(compact=True)
+        self.use_store = use_store(self.store)
+        self.use_store.__enter__()
+        self.bob = Artist.objects.create(name='Bob')
+        self.dave = Artist.objects.create(name='Dave')
+        self.annie = Fan.objects.create(name='Annie', artist=self.bob)
+        self.lottie = Fan.objects.create(name='Lottie', artist=self.dave)
+
+    def tearDown(self):
+        self.use_store.__exit__(None, None, None)
+
+    def test_rows_stored_as_records(self):
+        self.assertIsInstance(self.store[Artist][self.bob.pk], Record)
+        self.assertFalse(hasattr(self.store[Artist][self.bob.pk], '__dict__'))
+        bob = Artist.objects.get(name='Bob')
+        self.assertIsInstance(bob, Artist)
+        self.assertEqual(bob, self.bob)
+        self.assertIsNot(bob, Artist.objects.get(name='Bob'))
+        self.assertFalse(bob._state.adding)
+
+    def test_filters_read_records(self):
+        with self.assertMaxRowsScanned(1):
+            self.assertSequenceEqual(Fan.objects.filter(artist=self.bob), [self.annie])
+        self.assertSequenceEqual(Fan.objects.filter(artist__name='Dave'), [self.lottie])
+        self.assertSequenceEqual(Fan.objects.order_by('-artist__name'), [self.lottie, self.annie])
+        self.assertSequenceEqual(Fan.objects.values_list('name', 'artist__name'), [('Annie', 'Bob'), ('Lottie', 'Dave')])
+        self.assertEqual(Artist.objects.filter(name__gte='C').count(), 1)
+
+    def test_changes_saved(self):
+        bob = Artist.objects.get(name='Bob')
+        bob.name = 'Robert'
+        self.assertEqual(Artist.objects.filter(name='Bob').count(), 1)
+        bob.save()
+        self.assertSequenceEqual(Artist.objects.filter(name='Robert'), [bob])
+        Fan.objects.filter(name='Annie').update(artist=self.dave)
+        self.assertSequenceEqual(self.dave.fan_set.all(), [self.annie, self.lottie])
+        Artist.objects.filter(pk=self.dave.pk).delete()
+        self.assertEqual(Artist.objects.count(), 1)
+
+    def test_related_objects(self):
+        self.annie.friends.add(self.lottie)
+        annie = Fan.objects.select_related('artist').get(name='Annie')
+        self.assertEqual(annie.artist, self.bob)
+        self.assertEqual(Artist.objects.in_bulk([self.bob.pk]), {self.bob.pk: self.bob})
+        with self.assertNumMemoryQueries(1):
+            fans = list(Fan.objects.prefetch_related('friends__artist'))
+            self.assertEqual([list(fan.friends.all()) for fan in fans], [[self.lottie], []])
+            self.assertEqual(fans[0].friends.all()[0].artist, self.dave)
+        self.assertEqual(Artist.objects.annotate(fans=Count('fan')).filter(fans=1).count(), 2)
+        self.assertEqual(Fan.objects.aggregate(Max('artist__name')), {'artist__name__max': 'Dave'})
+
+    def test_result_cache(self):
+        with ResultCache() as cache:
+            bob, = Artist.objects.filter(name='Bob')
+            bob.name = 'Robert'
+            again, = Artist.objects.filter(name='Bob')
+            self.assertEqual(cache.hits, 1)
+            self.assertIsNot(again, bob)
+            self.assertEqual(again.name, 'Bob')
+
+    def test_snapshot_and_persistence(self):
+        state = snapshot()
+        Artist.objects.filter(pk=self.bob.pk).update(name='Robert')
+        Artist.objects.create(name='Eve')
+        restore(state)
+        self.assertSequenceEqual([a.name for a in Artist.objects.all()], ['Bob', 'Dave'])
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'store.snapshot')
+            dump_store(path)
+            self.assertFalse(load_store(path, DataStore()))
+            with use_store(DataStore(compact=True)):
+                self.assertTrue(load_store(path))
+                self.assertSequenceEqual(Fan.objects.filter(artist__name='Bob'), [self.annie])
+        finally:
+            shutil.rmtree(directory)
+
+
+@unittest.skipIf(numpy is None, 'numpy is not installed')
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class ColumnarStoreTests(MemoryAssertionsMixin, TestCase):
+    def setUp(self):
+        self.store = DataStore(columnar=True)
+        self.use_store = use_store(self.store)
+        self.use_store.__enter__()
+        self.bob = Artist.objects.create(name='Bob')
+        label = RecordLabel.objects.create(name='Circus Music')
+        album = Album.objects.create(name='All time circus classics', label=label, artist=self.bob)
+        self.tracks = Track.objects.bulk_create([
+            Track(number=i, name='Track %d' % i, album=album, artist=self.bob if i % 2 else None) for i in range(10)
+        ])
+
+    def tearDown(self):
+        self.use_store.__exit__(None, None, None)
+
+    def assertMasked(self, queryset, expected, masks=1):
+        with QueryRecorder() as recorder:
+            self.assertSequenceEqual(queryset, expected)
+        self.assertEqual(recorder.total('masks'), masks)
+
+    def test_columns(self):
+        columns = self.store[Track].columns()
+        self.assertEqual(columns.column('number')[0].dtype.kind, 'i')
+        self.assertEqual(columns.column('name')[0].dtype.kind, 'O')
+        values, nulls = columns.column('artist_id')
+        self.assertEqual(values.dtype.kind, 'i')
+        self.assertEqual(nulls.tolist(), [i % 2 == 0 for i in range(10)])
+        self.assertIs(self.store[Track].columns(), columns)
+        Track.objects.filter(number=0).update(name='First')
+        self.assertIsNot(self.store[Track].columns(), columns)
+
+    def test_masked_filters(self):
+        tracks = self.tracks
+        self.assertMasked(Track.objects.filter(number__gte=3, number__lt=6), tracks[3:6])
+        self.assertMasked(Track.objects.exclude(number__in=[1, 2, 3]).filter(number__lte=5), [tracks[0], tracks[4], tracks[5]])
+        self.assertMasked(Track.objects.filter(Q(number__lt=1) | Q(name__gt='Track 8')), [tracks[0], tracks[9]])
+        self.assertMasked(Track.objects.filter(artist__isnull=True, number__range=(3, 6)), [tracks[4], tracks[6]])
+        self.assertMasked(Track.objects.filter(name__startswith='Track 1', number__lt=5), [tracks[1]])
+        self.assertMasked(Track.objects.filter(number__gt=7, artist__name='Bob'), [tracks[9]])
+        self.assertMasked(Track.objects.filter(number=3), [tracks[3]], masks=0)
+        self.assertMasked(Track.objects.filter(number__gt=7.5), tracks[8:], masks=0)
+
+    def test_masked_count_and_aggregates(self):
+        with self.assertMaxRowsScanned(0):
+            self.assertEqual(Track.objects.filter(number__gt=4).count(), 5)
+            self.assertEqual(Track.objects.filter(number__gt=4)[1:3].count(), 2)
+            self.assertTrue(Track.objects.filter(artist__isnull=False).exists())
+            self.assertFalse(Track.objects.filter(number__gt=10).exists())
+            self.assertEqual(Track.objects.filter(number__lt=5).aggregate(
+                Count('pk'), Sum('number'), Avg('number'), Min('name'), Max('artist'), artists=Count('artist', distinct=True),
+            ), {
+                'pk__count': 5, 'number__sum': 10, 'number__avg': 2.0, 'name__min': 'Track 0',
+                'artist__max': self.bob.pk, 'artists': 1,
+            })
+            self.assertEqual(Track.objects.filter(number__gt=10).aggregate(Sum('number')), {'number__sum': None})
+        Track.objects.filter(number__gte=8).delete()
+        self.assertEqual(Track.objects.filter(number__gt=4).count(), 3)
+        self.assertEqual(Track.objects.aggregate(Max('number')), {'number__max': 7})
+
+    def test_compact_columnar(self):
+        with use_store(DataStore(compact=True, columnar=True)):
+            Artist.objects.bulk_create([Artist(name=name) for name in ('Bob', 'Carl', 'Dave')])
+            self.assertSequenceEqual([a.name for a in Artist.objects.filter(name__gte='C')], ['Carl', 'Dave'])
+            self.assertEqual(Artist.objects.filter(pk__lt=3).count(), 2)
+
+
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class PersistedStoreTests(TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'store.snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        data_store.clear()
+
+    def populate(self):
+        bob = Artist.objects.create(name='Bob')
+        annie = Fan.objects.create(name='Annie', artist=bob)
+        lottie = Fan.objects.create(name='Lottie', artist=bob)
+        annie.friends.add(lottie)
+        self.assertEqual(Artist.objects.filter(name__gte='A').count(), 1)
+
+    def test_dump_and_load(self):
+        self.populate()
+        dump_store(self.path)
+        with use_store(DataStore()):
+            self.assertTrue(load_store(self.path))
+            bob = Artist.objects.get(name='Bob')
+            annie = Fan.objects.get(name='Annie')
+            self.assertEqual(annie.artist, bob)
+            self.assertSequenceEqual([fan.name for fan in bob.fan_set.all()], ['Annie', 'Lottie'])
+            self.assertSequenceEqual([fan.name for fan in annie.friends.all()], ['Lottie'])
+            self.assertSequenceEqual(Artist.objects.filter(name__gte='A'), [bob])
+            self.assertEqual(Artist.objects.create(name='Dave').pk, 2)
+
+    def test_missing_or_stale(self):
+        self.assertFalse(load_store(self.path))
+        self.populate()
+        dump_store(self.path)
+        with mock.patch('test_db.meta_signature', return_value='changed'):
+            self.assertFalse(load_store(self.path))
+        self.assertEqual(Artist.objects.count(), 1)
+
+    def test_load_or_populate(self):
+        populate = mock.Mock(side_effect=self.populate)
+        load_or_populate(self.path, populate)
+        data_store.clear()
+        load_or_populate(self.path, populate)
+        self.assertEqual(populate.call_count, 1)
+        self.assertEqual(Fan.objects.count(), 2)
+
+
+@memory_only
+@no_db_tests
+@test_db('music.models')
+class FixtureTests(SnapshotTestMixin, TestCase):
+    memory_fixtures = ['music']
+
+    def test_fixture_loaded(self):
+        track = Track.objects.get()
+        self.assertEqual(track.track_details(), correct_details)
+        lottie = Fan.objects.get(name='Lottie')
+        self.assertSequenceEqual([fan.name for fan in lottie.friends.all()], ['Annie'])
+        self.assertSequenceEqual([fan.name for fan in Artist.objects.get(pk=2).fan_set.all()], ['Annie', 'Lottie'])
+
+    def test_reload_replaces_rows(self):
+        Artist.objects.filter(pk=1).update(name='Bob')
+        self.assertEqual(load_fixture('music'), 7)
+        self.assertEqual(Artist.objects.get(pk=1).name, 'Freddy the Clown')
+        self.assertEqual(Artist.objects.count(), 2)
+        self.assertEqual(Artist.objects.create(name='Dave').pk, 3)
+
+    def test_streaming(self):
+        fixture = StringIO.StringIO('[{"model": "music.artist", "pk": 1, "fields": {"name": "Bob"}},\n {"model": "music.artist", "pk": 2, "fields": {"name": "Dave"}}]')
+        self.assertEqual([item['pk'] for item in iter_fixture(fixture, chunk_size=7)], [1, 2])
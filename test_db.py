@@ -1,67 +1,2089 @@
+import copy
+import cPickle
+import hashlib
+import heapq
+import json
+import os
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from datetime import date, datetime
+from collections import Counter, OrderedDict, defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from importlib import import_module
+from itertools import count, imap, islice, product
+from operator import attrgetter, itemgetter
+
+from django.conf import settings
+from django.core.exceptions import FieldError
+from django.core.serializers.base import DeserializationError
+from django.db import DEFAULT_DB_ALIAS, IntegrityError
+from django.db.models import CharField, DateField, Model, Q, TextField, get_apps, get_model
 from django.db.models.constants import LOOKUP_SEP
 from django.db.models.query import QuerySet as DjangoQuerySet
 from django.utils.tree import Node
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class NoLock(object):
+    """Stands in for a lock where nothing is shared between threads."""
+    def __enter__(self):
+        pass
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+NO_LOCK = NoLock()
+
+
+class DataStore(dict):
+    """The tables and many to many relations for a set of tests.
+
+    Tables are keyed by model, and relations by their through model and the
+    name of their source field. A store which is `shared` between threads
+    has a lock which every write takes, so a live server thread can write to
+    the store the tests are using. Stores which each belong to one thread,
+    such as those for test shards run side by side, can do without.
+
+    A `compact` store keeps its rows as `Record`s rather than model instances,
+    which takes a fraction of the memory for big tables. A `columnar` store
+    filters its tables as NumPy arrays of each field, which needs numpy.
+    """
+    def __init__(self, shared=False, compact=False, columnar=False):
+        super(DataStore, self).__init__()
+        if columnar and numpy is None:
+            raise ImportError("A columnar data store needs numpy to be installed")
+        self.lock = threading.RLock() if shared else NO_LOCK
+        self.compact = compact
+        self.columnar = columnar
+
+    def make_table(self, model):
+        return (CompactTable if self.compact else Table)(model, self.lock, self.columnar)
+
+
+class Context(threading.local):
+    """The store, recorders and result caches in use by each thread."""
+    def __init__(self):
+        self.store = None
+        self.recorders = []
+        self.result_caches = []
+
+
+context = Context()
+# Threads share this store unless they say otherwise.
+default_store = DataStore(shared=True)
+
+
+def get_store():
+    """The data store in use by the current thread."""
+    store = context.store
+    return default_store if store is None else store
+
+
+@contextmanager
+def use_store(store):
+    """Use `store` as the data store for the current thread for a while."""
+    previous = context.store
+    context.store = store
+    try:
+        yield store
+    finally:
+        context.store = previous
+
+
+class CurrentStore(object):
+    """Stands for whichever store is in use by the current thread.
+
+    This lets `data_store` be imported and used like a plain dict.
+    """
+    def __getattr__(self, name):
+        return getattr(get_store(), name)
+
+    def __getitem__(self, key):
+        return get_store()[key]
+
+    def __setitem__(self, key, value):
+        get_store()[key] = value
+
+    def __delitem__(self, key):
+        del get_store()[key]
+
+    def __contains__(self, key):
+        return key in get_store()
+
+    def __iter__(self):
+        return iter(get_store())
+
+    def __len__(self):
+        return len(get_store())
+
+
+data_store = CurrentStore()
+field_cache = {}
+# Every write to a table stamps it with a new version.
+versions = count(1)
+
+
+def get_concrete_field(model, name):
+    """Find the concrete field on `model` called `name`, or None.
+
+    Fields can be referred to by name, attname or as `pk`. The lookup table is
+    built once per model.
+    """
+    try:
+        fields = field_cache[model]
+    except KeyError:
+        opts = model._meta
+        fields = field_cache[model] = {'pk': opts.pk}
+        for field in opts.concrete_fields:
+            fields[field.name] = field
+            fields[field.attname] = field
+    return fields.get(name)
+
+
+class HashIndex(object):
+    """Maps the values of a single field to the pks of the rows holding them.
+
+    We also remember which value each row was filed under, as rows are usually
+    modified in place before we're told about it. A tuple of attnames indexes
+    the rows by a tuple of their values, for `unique_together`.
+    """
+    def __init__(self, attname, table):
+        self.attname = attname
+        self.key = attrgetter(*attname) if isinstance(attname, tuple) else attrgetter(attname)
+        self.table = table
+        self.buckets = {}
+        self.keys = {}
+        for pk, row in table.iteritems():
+            self.add(pk, row)
+
+    def add(self, pk, row):
+        key = self.key(row)
+        self.buckets.setdefault(key, set()).add(pk)
+        self.keys[pk] = key
+
+    def remove(self, pk):
+        key = self.keys.pop(pk)
+        bucket = self.buckets[key]
+        bucket.discard(pk)
+        if not bucket:
+            del self.buckets[key]
+
+    def refresh(self, pk, row):
+        """File the row under its current value if that has changed."""
+        key = self.key(row)
+        if key != self.keys[pk]:
+            self.remove(pk)
+            self.add(pk, row)
+
+    def add_many(self, rows):
+        for pk, row in rows:
+            self.add(pk, row)
+
+    def refresh_many(self, rows):
+        for pk, row in rows:
+            self.refresh(pk, row)
+
+    def lookup(self, values):
+        """Find the pks of the rows matching any of the values."""
+        if len(values) == 1:
+            return self.buckets.get(values[0], ())
+        pks = set()
+        for value in values:
+            pks.update(self.buckets.get(value, ()))
+        return pks
+
+
+class SortedIndex(object):
+    """Keeps the values of a single field in order, for range lookups.
+
+    The values live in a sorted list which we bisect, with the pks of their
+    rows in a parallel list. Null values never match a comparison so they are
+    left out altogether.
+    """
+    def __init__(self, attname, table):
+        self.attname = attname
+        self.table = table
+        self.values = []
+        self.pks = []
+        self.keys = {}
+        for pk, row in table.iteritems():
+            self.add(pk, row)
+
+    def add(self, pk, row):
+        key = getattr(row, self.attname)
+        self.keys[pk] = key
+        if key is None:
+            return
+        position = bisect_right(self.values, key)
+        self.values.insert(position, key)
+        self.pks.insert(position, pk)
+
+    def remove(self, pk):
+        key = self.keys.pop(pk)
+        if key is None:
+            return
+        start = bisect_left(self.values, key)
+        end = bisect_right(self.values, key, start)
+        position = self.pks.index(pk, start, end)
+        del self.values[position]
+        del self.pks[position]
+
+    def refresh(self, pk, row):
+        """File the row under its current value if that has changed."""
+        key = getattr(row, self.attname)
+        if key != self.keys[pk]:
+            self.remove(pk)
+            self.add(pk, row)
+
+    def add_many(self, rows):
+        """File a batch of rows with a single sort rather than a bisect each."""
+        entries = []
+        for pk, row in rows:
+            key = self.keys[pk] = getattr(row, self.attname)
+            if key is not None:
+                entries.append((key, pk))
+        if not entries:
+            return
+        # The sort is stable, so rows already filed stay ahead of equal new ones.
+        entries = sorted(zip(self.values, self.pks) + entries, key=itemgetter(0))
+        self.values = [key for key, pk in entries]
+        self.pks = [pk for key, pk in entries]
+
+    def refresh_many(self, rows):
+        """Re-file the rows from a batch whose values have changed, all at once."""
+        changed = [(pk, row) for pk, row in rows if getattr(row, self.attname) != self.keys[pk]]
+        if len(changed) < 2:
+            for pk, row in changed:
+                self.refresh(pk, row)
+            return
+        moved = set(pk for pk, row in changed)
+        kept = [(key, pk) for key, pk in zip(self.values, self.pks) if pk not in moved]
+        self.values = [key for key, pk in kept]
+        self.pks = [pk for key, pk in kept]
+        self.add_many(changed)
+
+    def between(self, low=None, high=None, include_low=True, include_high=True):
+        """Find the pks of the rows with values in a range.
+
+        Either end of the range can be left open by passing None.
+        """
+        start, end = 0, len(self.values)
+        if low is not None:
+            start = (bisect_left if include_low else bisect_right)(self.values, low)
+        if high is not None:
+            end = (bisect_right if include_high else bisect_left)(self.values, high)
+        return self.pks[start:end]
+
+    def prefix(self, prefix):
+        """Find the pks of the rows whose values start with `prefix`."""
+        start = end = bisect_left(self.values, prefix)
+        values = self.values
+        while end < len(values) and values[end].startswith(prefix):
+            end += 1
+        return self.pks[start:end]
+
+
+class Table(OrderedDict):
+    """The rows stored for a single model, keyed by pk in insertion order.
+
+    Indexes over the rows are built lazily the first time a field is looked
+    up, and kept up to date by `Query.create`, `Query.update` and
+    `Query.delete` from then on. Exact lookups use a `HashIndex`, and range
+    lookups a `SortedIndex`. Foreign keys are always indexed, as that is how
+    related managers find the rows pointing at an object.
+
+    Unique fields and `unique_together` sets are always indexed too, so that
+    writes which would break them can be turned away with an IntegrityError
+    before anything changes. PKs come from `counter`, which only goes up, so
+    they aren't handed out again after a delete.
+
+    Writes hold the lock of the `DataStore` the table belongs to, and so do
+    reads which go through the rows, so that they don't see a write half
+    done. A `columnar` table is filtered through its `Columns` where it can.
+    """
+    compact = False
+
+    def __init__(self, model, lock=None, columnar=False):
+        super(Table, self).__init__()
+        self.model = model
+        self.lock = lock or NO_LOCK
+        self.columnar = columnar
+        self._columns = None
+        self.indexes = {}
+        self.sequence = {}
+        self.next_sequence = 0
+        self.counter = 1
+        self.version = next(versions)
+        opts = model._meta
+        self.unique = [field.attname for field in opts.concrete_fields if field.unique and not field.primary_key]
+        for names in opts.unique_together:
+            attnames = tuple(opts.get_field(name).attname for name in names)
+            self.unique.append(attnames[0] if len(attnames) == 1 else attnames)
+        self.index_keys()
+
+    def index_keys(self):
+        """Build the indexes every table has, on its foreign keys and unique fields."""
+        for field in self.model._meta.concrete_fields:
+            if field.rel:
+                self.index(field.attname)
+        for attname in self.unique:
+            self.index(attname)
+
+    def constrains(self, attnames):
+        """Whether changing some attnames could break the pk or a unique constraint."""
+        if self.model._meta.pk.attname in attnames:
+            return True
+        return any(not attnames.isdisjoint(unique_attnames(attname)) for attname in self.unique)
+
+    def check_unique(self, rows, attnames=None):
+        """Raise IntegrityError if writing some rows would break a unique constraint.
+
+        `rows` are (old pk, row) pairs, with an old pk of None for new rows.
+        Rows are checked against each other as well as the table, so that
+        a batch is judged on the state it leaves behind. Each check is a
+        hash lookup. Constraints not on `attnames` are left alone, if given.
+        Nulls never clash, as in SQL.
+        """
+        changed = set(pk for pk, row in rows if pk is not None)
+        moved = set(pk for pk, row in rows if pk is not None and row.pk != pk)
+        seen = set()
+        for pk, row in rows:
+            new = row.pk
+            if new != pk:
+                if new in seen or (new in self and new not in moved):
+                    raise self.unique_error(self.model._meta.pk.attname)
+                seen.add(new)
+        for attname in self.unique:
+            if attnames is not None and attnames.isdisjoint(unique_attnames(attname)):
+                continue
+            index = self.index(attname)
+            seen = set()
+            for pk, row in rows:
+                key = index.key(row)
+                if key is None or (isinstance(key, tuple) and None in key):
+                    continue
+                if key in seen or any(other not in changed for other in index.buckets.get(key, ())):
+                    raise self.unique_error(attname)
+                seen.add(key)
+
+    def stored_pk(self, row):
+        """The pk a stored row is kept under, which may not be the one it has.
+
+        The pk of a stored instance can be changed by hand before save(), in
+        which case we have to go looking for it.
+        """
+        pk = row.pk
+        if self.get(pk) is row:
+            return pk
+        for key, stored in self.iteritems():
+            if stored is row:
+                return key
+        return pk
+
+    def reset_row(self, pk, row, attnames):
+        """Put back the values of `attnames` which the indexes last filed a row under.
+
+        Stored rows are changed in place before we hear about it, so when a
+        write is turned away this is the only record of what they held.
+        """
+        setattr(row, self.model._meta.pk.attname, pk)
+        for index in self.indexes.values():
+            names = unique_attnames(index.attname)
+            if attnames.isdisjoint(names) or pk not in index.keys:
+                continue
+            values = index.keys[pk]
+            for name, value in zip(names, values if len(names) > 1 else (values,)):
+                setattr(row, name, value)
+        # Any index built while the row was changed has to be put right too.
+        for index in self.indexes.values():
+            if pk in index.keys:
+                index.refresh(pk, row)
+
+    def unique_error(self, attname):
+        opts = self.model._meta
+        columns = [get_concrete_field(self.model, name).column for name in unique_attnames(attname)]
+        return IntegrityError('UNIQUE constraint failed: %s' % ', '.join(
+            '%s.%s' % (opts.db_table, column) for column in columns))
+
+    def index(self, attname, kind=HashIndex):
+        try:
+            return self.indexes[(kind, attname)]
+        except KeyError:
+            with self.lock:
+                index = self.indexes.get((kind, attname))
+                if index is None:
+                    index = self.indexes[(kind, attname)] = kind(attname, self)
+                return index
+
+    def columns(self):
+        """The `Columns` of the table as it is now, made afresh after any write."""
+        columns = self._columns
+        if columns is None or columns.version != self.version:
+            with self.lock:
+                columns = self._columns = Columns(self)
+        return columns
+
+    def fetch(self, pks):
+        """Get the rows for some pks, in storage order, skipping any which have gone."""
+        with self.lock:
+            return [self[pk] for pk in sorted((pk for pk in pks if pk in self), key=self.sequence.__getitem__)]
+
+    def rows(self, exclude=()):
+        """Go through the rows in storage order, leaving out the pks in `exclude`.
+
+        Where the table is shared between threads we take a list of them under
+        the lock, rather than iterate over rows which may change as we go.
+        """
+        if self.lock is NO_LOCK:
+            if not exclude:
+                return self.itervalues()
+            return (row for pk, row in self.iteritems() if pk not in exclude)
+        with self.lock:
+            if not exclude:
+                return self.values()
+            return [row for pk, row in self.iteritems() if pk not in exclude]
+
+    def next_pk(self):
+        with self.lock:
+            pk = self.counter
+            self.counter += 1
+            return pk
+
+    def assign_pks(self, rows):
+        """Give the rows without pks a contiguous block of them.
+
+        The block comes after any pks set by hand in the batch, so the two
+        can't clash.
+        """
+        with self.lock:
+            missing = []
+            for row in rows:
+                pk = row.pk
+                if not pk:
+                    missing.append(row)
+                elif isinstance(pk, (int, long)) and pk >= self.counter:
+                    self.counter = pk + 1
+            for pk, row in enumerate(missing, self.counter):
+                row.pk = pk
+            self.counter += len(missing)
+
+    def insert(self, row):
+        with self.lock:
+            self.check_unique([(None, row)])
+            self._insert(row)
+
+    def _insert(self, row):
+        with self.lock:
+            self.version = next(versions)
+            pk = row.pk
+            if isinstance(pk, (int, long)) and pk >= self.counter:
+                self.counter = pk + 1
+            self.sequence[pk] = self.next_sequence
+            self.next_sequence += 1
+            self[pk] = row
+            for index in self.indexes.values():
+                index.add(pk, row)
+
+    def insert_many(self, rows):
+        """Insert a batch of rows, filing them in each index in one go.
+
+        Nothing goes in if any of the rows would break a unique constraint.
+        """
+        rows = list(rows)
+        with self.lock:
+            self.check_unique([(None, row) for row in rows])
+            self.version = next(versions)
+            batch = []
+            for row in rows:
+                pk = row.pk
+                if isinstance(pk, (int, long)) and pk >= self.counter:
+                    self.counter = pk + 1
+                self.sequence[pk] = self.next_sequence
+                self.next_sequence += 1
+                self[pk] = row
+                batch.append((pk, row))
+            for index in self.indexes.values():
+                index.add_many(batch)
+
+    def discard(self, pk):
+        with self.lock:
+            self.version = next(versions)
+            for index in self.indexes.values():
+                index.remove(pk)
+            del self[pk]
+            del self.sequence[pk]
+
+    def refresh(self, pk, row):
+        """Re-file a row after it has been changed.
+
+        Should the pk itself have changed, the row moves to the end of the
+        table under its new key.
+        """
+        with self.lock:
+            self.check_unique([(pk, row)])
+            self.version = next(versions)
+            if row.pk != pk:
+                self.discard(pk)
+                self._insert(row)
+                return
+            for index in self.indexes.values():
+                index.refresh(pk, row)
+
+    def refresh_many(self, rows, attnames=None):
+        """Re-file a batch of (old pk, row) pairs after they have been changed.
+
+        Only the indexes on `attnames` are looked at, if given. Should the
+        changes break a unique constraint, IntegrityError is raised before
+        anything is re-filed.
+        """
+        rows = list(rows)
+        with self.lock:
+            self.check_unique(rows, attnames)
+            self.version = next(versions)
+            batch = []
+            for pk, row in rows:
+                if row.pk != pk:
+                    self.discard(pk)
+                    self._insert(row)
+                else:
+                    batch.append((pk, row))
+            for index in self.indexes.values():
+                if attnames is None or not attnames.isdisjoint(unique_attnames(index.attname)):
+                    index.refresh_many(batch)
+
+    def capture(self):
+        """Capture the contents of the table so they can be put back later.
+
+        Rows are changed in place before we hear about it, so we have to keep
+        a copy of each row's attributes now rather than when it is written.
+        """
+        rows = [(pk, row, self.row_state(row)) for pk, row in self.iteritems()]
+        return rows, self.counter, self.version
+
+    def rollback(self, state):
+        """Put back the contents of the table from `capture()`.
+
+        Indexes are thrown away, and rebuilt if they're needed again, apart
+        from those from `index_keys()` which are rebuilt straight away.
+        """
+        rows, counter, version = state
+        with self.lock:
+            self.clear()
+            self.indexes = {}
+            self.sequence = {}
+            for sequence, (pk, row, state) in enumerate(rows):
+                self.set_row_state(row, state)
+                self[pk] = row
+                self.sequence[pk] = sequence
+            self.next_sequence = len(rows)
+            self.counter = counter
+            self.version = version
+            self._columns = None
+            self.index_keys()
+
+    def materialize(self, row):
+        """The model instance for a row, which is the row itself here."""
+        return row
+
+    def detach(self, row):
+        """A model instance for a row which can be changed without touching the row."""
+        obj = copy.copy(row)
+        obj._state = copy.copy(row._state)
+        return obj
+
+    def row_state(self, row, cached=True):
+        """The attributes of a row, leaving out cached related objects unless `cached`."""
+        if cached:
+            return row.__dict__.copy()
+        return dict((name, value) for name, value in row.__dict__.iteritems() if not name.endswith('_cache'))
+
+    def set_row_state(self, row, state):
+        row.__dict__.clear()
+        row.__dict__.update(state)
+
+    def blank_row(self):
+        return self.model.__new__(self.model)
+
+
+def unique_attnames(attname):
+    """The attnames covered by an index or constraint on one or a tuple of them."""
+    return attname if isinstance(attname, tuple) else (attname,)
+
+
+class Record(object):
+    """A compact stand in for a model instance, kept by a `CompactTable`.
+
+    Only the values of the concrete fields are kept, in slots named after
+    their attnames, so filters and indexes read them just as they would an
+    instance. Foreign keys can be followed by name to the related record.
+    A subclass is made for each model by `record_class()`.
+    """
+    __slots__ = ()
+    _model = None
+    _attnames = ()
+
+    def __init__(self, *values):
+        for attname, value in zip(self._attnames, values):
+            setattr(self, attname, value)
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self._model is other._model and self.pk == other.pk
+        return isinstance(other, self._model) and self.pk == other.pk
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.pk)
+
+    def __repr__(self):
+        return '<%s: %s>' % (type(self).__name__, self.pk)
+
+    def _values(self):
+        return tuple(getattr(self, attname) for attname in self._attnames)
+
+    def _materialize(self):
+        """Make a model instance with the values of the record."""
+        obj = self._model(*self._values())
+        obj._state.adding = False
+        obj._state.db = DEFAULT_DB_ALIAS
+        return obj
+
+
+record_classes = {}
+
+
+def record_class(model):
+    """Get the `Record` subclass holding rows of `model`, making it if need be."""
+    try:
+        return record_classes[model]
+    except KeyError:
+        pass
+    opts = model._meta
+    attnames = tuple(str(field.attname) for field in opts.concrete_fields)
+    attrs = {
+        '__slots__': attnames,
+        '_model': model,
+        '_attnames': attnames,
+        'pk': related_property(opts.pk.attname),
+    }
+    for field in opts.concrete_fields:
+        if field.rel:
+            attrs[str(field.name)] = related_property(field.attname, field)
+    cls = record_classes[model] = type(str('%sRecord' % model.__name__), (Record,), attrs)
+    return cls
+
+
+def related_property(attname, field=None):
+    """A property reading and writing `attname` on a record.
+
+    With a foreign key `field`, the property gives the related record, and
+    takes a model instance or record to point at.
+    """
+    if field is None:
+        return property(attrgetter(attname), lambda self, value: setattr(self, attname, value))
+    target = field.rel.get_related_field().attname
+
+    def get(self):
+        return related_row(field, getattr(self, attname))
+
+    def set(self, value):
+        setattr(self, attname, None if value is None else getattr(value, target))
+    return property(get, set)
+
+
+class CompactTable(Table):
+    """A table keeping its rows as `Record`s rather than model instances.
+
+    Objects are packed into records as they go in, and instances are only
+    made from them as they come out of queries, so each object that is
+    handed out is a copy of its own, as it would be from a real database.
+    Changes need saving to reach the table.
+    """
+    compact = True
+
+    def __init__(self, model, lock=None, columnar=False):
+        self.record_class = record_class(model)
+        super(CompactTable, self).__init__(model, lock, columnar)
+
+    def pack(self, obj):
+        if isinstance(obj, Record):
+            return obj
+        return self.record_class(*[getattr(obj, attname) for attname in self.record_class._attnames])
+
+    def insert(self, row):
+        super(CompactTable, self).insert(self.pack(row))
+
+    def _insert(self, row):
+        super(CompactTable, self)._insert(self.pack(row))
+
+    def insert_many(self, rows):
+        super(CompactTable, self).insert_many([self.pack(row) for row in rows])
+
+    def materialize(self, row):
+        return row._materialize()
+
+    detach = materialize
+
+    def row_state(self, row, cached=True):
+        return row._values()
+
+    def set_row_state(self, row, state):
+        Record.__init__(row, *state)
+
+    def blank_row(self):
+        return self.record_class.__new__(self.record_class)
+
+
+# The NumPy types of the fields which get a column of their own type, by
+# internal type. Anything else goes in an object array.
+COLUMN_TYPES = {
+    'AutoField': 'int64',
+    'BigIntegerField': 'int64',
+    'IntegerField': 'int64',
+    'PositiveIntegerField': 'int64',
+    'PositiveSmallIntegerField': 'int64',
+    'SmallIntegerField': 'int64',
+    'FloatField': 'float64',
+    'BooleanField': 'bool',
+    'NullBooleanField': 'bool',
+    'DateField': 'datetime64[D]',
+}
+# Lookups which can be answered by a mask over a column.
+MASKED_LOOKUPS = frozenset(['exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range', 'isnull'])
+
+
+class Columns(object):
+    """The values of each field of a table as NumPy arrays, in storage order.
+
+    Numeric, boolean and date fields get an array of their own type, and
+    anything else an object array. Nulls are kept in a mask of their own,
+    with a stand in value in the array. Each array is made the first time
+    it is needed, and the lot are thrown away once the table is written to,
+    so they suit tables which are loaded up and then queried.
+    """
+    def __init__(self, table):
+        self.table = table
+        self.version = table.version
+        self.rows = table.values()
+        self.arrays = {}
+
+    def __len__(self):
+        return len(self.rows)
+
+    def select(self, mask):
+        """The rows picked out by a mask, or all of them for None."""
+        if mask is None:
+            return self.rows
+        rows = self.rows
+        return [rows[i] for i in numpy.flatnonzero(mask).tolist()]
+
+    def column(self, attname):
+        """Get the (values, nulls) arrays for a field."""
+        try:
+            return self.arrays[attname]
+        except KeyError:
+            pass
+        field = get_concrete_field(self.table.model, attname)
+        while field.rel:
+            field = field.rel.get_related_field()
+        values = [getattr(row, attname) for row in self.rows]
+        nulls = numpy.fromiter((value is None for value in values), bool, len(values))
+        dtype = COLUMN_TYPES.get(field.get_internal_type())
+        array = None
+        if dtype is not None:
+            array = self._typed_array(values, numpy.dtype(dtype))
+        if array is None:
+            array = numpy.empty(len(values), object)
+            array[:] = values
+        column = self.arrays[attname] = array, nulls
+        return column
+
+    def _typed_array(self, values, dtype):
+        """Make an array of `dtype`, or None if any of the values won't fit it."""
+        fill = numpy.zeros(1, dtype)[0]
+        items = []
+        for value in values:
+            if value is None:
+                items.append(fill)
+                continue
+            item = column_value(dtype.kind, value)
+            if item is None:
+                return None
+            items.append(item)
+        try:
+            return numpy.array(items, dtype)
+        except (TypeError, ValueError, OverflowError):
+            return None
+
+    def convert(self, array, value):
+        """Turn a lookup value into the type of a column, or None if it won't go."""
+        if array.dtype.kind == 'O':
+            return value
+        return column_value(array.dtype.kind, value)
+
+    def mask(self, attname, lookup, value):
+        """Find the rows matching a single lookup as a boolean array.
+
+        Returns None if the lookup or value can't be done this way, in which
+        case the rows have to be checked one at a time.
+        """
+        if lookup not in MASKED_LOOKUPS:
+            return None
+        array, nulls = self.column(attname)
+        if lookup == 'isnull':
+            return nulls if value else ~nulls
+        try:
+            if lookup == 'in':
+                return self._in(array, nulls, value)
+            if value is None:
+                return nulls if lookup == 'exact' else None
+            if lookup == 'range':
+                low, high = [self.convert(array, end) for end in value]
+                if low is None or high is None:
+                    return None
+                mask = (array >= low) & (array <= high)
+            else:
+                value = self.convert(array, value)
+                if value is None or isinstance(value, (tuple, list, set, frozenset)):
+                    return None
+                mask = COMPARISONS[lookup](array, value)
+        except (TypeError, ValueError, OverflowError):
+            return None
+        if not isinstance(mask, numpy.ndarray):
+            return None
+        return mask & ~nulls
+
+    def _in(self, array, nulls, values):
+        if array.dtype.kind == 'O':
+            try:
+                mask = numpy.fromiter((value in values for value in array), bool, len(array))
+            except TypeError:
+                return None
+        else:
+            converted = []
+            for value in values:
+                if value is not None:
+                    value = self.convert(array, value)
+                    if value is None:
+                        return None
+                    converted.append(value)
+            mask = numpy.in1d(array, numpy.array(converted, array.dtype))
+        mask &= ~nulls
+        if None in values:
+            mask |= nulls
+        return mask
+
+
+def column_value(kind, value):
+    """Check a value will go in an array of a NumPy kind, converting dates.
+
+    Returns None for values which won't, as comparing them with the array
+    wouldn't give the same answers as comparing them with the rows.
+    """
+    if kind == 'M':
+        if isinstance(value, date) and not isinstance(value, datetime):
+            return numpy.datetime64(value, 'D')
+        return None
+    if kind == 'b':
+        return value if isinstance(value, bool) else None
+    if kind == 'i':
+        return value if isinstance(value, (int, long)) else None
+    return value if isinstance(value, (int, long, float)) else None
+
+
+COMPARISONS = {
+    'exact': lambda array, value: array == value,
+    'gt': lambda array, value: array > value,
+    'gte': lambda array, value: array >= value,
+    'lt': lambda array, value: array < value,
+    'lte': lambda array, value: array <= value,
+}
+
+
+def get_table(model):
+    """Get the table for a model's rows in the current store, making it if need be."""
+    store = get_store()
+    try:
+        return store[model]
+    except KeyError:
+        with store.lock:
+            table = store.get(model)
+            if table is None:
+                table = store[model] = store.make_table(model)
+            return table
+
+
+class Relation(object):
+    """The edges of a many to many relation, indexed in both directions.
+
+    This stands in for the through table. `forward` maps the pk of each
+    object on the side which defines the field to the set of pks it is
+    related to, and `reverse` maps the other way round.
+    """
+    def __init__(self, through, source_name, lock=None):
+        self.through = through
+        self.source_name = source_name
+        self.lock = lock or NO_LOCK
+        self.forward = {}
+        self.reverse = {}
+        self.version = next(versions)
+
+    def add(self, source, target):
+        with self.lock:
+            self.version = next(versions)
+            self.forward.setdefault(source, set()).add(target)
+            self.reverse.setdefault(target, set()).add(source)
 
-data_store = {}
+    def remove(self, source, target):
+        with self.lock:
+            self.version = next(versions)
+            self._unlink(self.forward, source, target)
+            self._unlink(self.reverse, target, source)
+
+    def clear(self, pk, forward=True):
+        """Remove every edge from `pk`, on the source side if `forward`."""
+        with self.lock:
+            self.version = next(versions)
+            edges, other = (self.forward, self.reverse) if forward else (self.reverse, self.forward)
+            for related in edges.pop(pk, ()):
+                self._unlink(other, related, pk)
+
+    def _unlink(self, edges, pk, related):
+        pks = edges.get(pk)
+        if pks is not None:
+            pks.discard(related)
+            if not pks:
+                del edges[pk]
+
+    def capture(self):
+        forward = dict((pk, set(pks)) for pk, pks in self.forward.iteritems())
+        return forward, self.version
+
+    def rollback(self, state):
+        forward, version = state
+        reverse = {}
+        for source, targets in forward.iteritems():
+            for target in targets:
+                reverse.setdefault(target, set()).add(source)
+        with self.lock:
+            self.forward = dict((pk, set(pks)) for pk, pks in forward.iteritems())
+            self.reverse = reverse
+            self.version = version
+
+
+def stored_relations(model):
+    """Find the relations in the current store which `model` takes part in.
+
+    Yields (relation, forward) pairs, with `forward` set where the model is
+    on the source side. A relation from a model to itself comes up twice.
+    """
+    store = get_store()
+    opts = model._meta
+    fields = [(field, True) for field in opts.many_to_many]
+    fields.extend((related.field, False) for related in opts.get_all_related_many_to_many_objects())
+    for field, forward in fields:
+        relation = store.get((field.rel.through, field.m2m_field_name()))
+        if relation is not None:
+            yield relation, forward
+
+
+def get_relation(through, source_name):
+    """Get the edges of a many to many relation in the current store, making them if need be."""
+    store = get_store()
+    key = (through, source_name)
+    try:
+        return store[key]
+    except KeyError:
+        with store.lock:
+            return store.setdefault(key, Relation(through, source_name, store.lock))
+
+
+m2m_cache = {}
+
+
+def get_m2m_field(model, name):
+    """Find the many to many relation called `name` on `model`, or None.
+
+    Returns the field along with which way round it is from this model: the
+    name of the direction in the `Relation` to look up related pks in to
+    find rows of `model`. Filtering on a field defined on the model means
+    looking it up in `reverse`, and on the related name `forward`.
+    """
+    try:
+        fields = m2m_cache[model]
+    except KeyError:
+        opts = model._meta
+        fields = m2m_cache[model] = {}
+        for related in opts.get_all_related_many_to_many_objects():
+            fields[related.field.related_query_name()] = related.field, 'forward'
+        for field in opts.many_to_many:
+            fields[field.name] = field, 'reverse'
+    return fields.get(name)
+
+
+accessor_cache = {}
+
+
+def get_accessor(model, name, query_name=False):
+    """Find what the attribute `name` of `model` holds related objects for.
+
+    Returns a (kind, field) pair, or None. The kind is 'fk' for a foreign key,
+    'reverse_fk' for the manager of the objects with a foreign key to this
+    one, and 'm2m' or 'reverse_m2m' for either end of a many to many field.
+    With `query_name` the reverse relations go by the names used in lookups
+    rather than the names of their managers.
+    """
+    try:
+        accessors = accessor_cache[(model, query_name)]
+    except KeyError:
+        opts = model._meta
+        accessors = accessor_cache[(model, query_name)] = {}
+        for field in opts.concrete_fields:
+            if field.rel:
+                accessors[field.name] = 'fk', field
+        for related in opts.get_all_related_objects():
+            if related.field.rel.multiple:
+                name_of = related.field.related_query_name if query_name else related.get_accessor_name
+                accessors[name_of()] = 'reverse_fk', related.field
+        for field in opts.many_to_many:
+            accessors[field.name] = 'm2m', field
+        for related in opts.get_all_related_many_to_many_objects():
+            name_of = related.field.related_query_name if query_name else related.get_accessor_name
+            accessors[name_of()] = 'reverse_m2m', related.field
+    return accessors.get(name)
+
+
+def lower(value):
+    return value.lower()
+
+
+def text(value):
+    """Cast a value to text, as a database would for a text lookup on another type."""
+    return None if value is None else unicode(value)
+
+
+def lower_text(value):
+    return None if value is None else unicode(value).lower()
+
+
+def collection(values):
+    """Turn the value of an `__in` lookup into something quick to search."""
+    values = list(values)
+    try:
+        return frozenset(values)
+    except TypeError:
+        return values
+
+
+def pk_value(value):
+    return value.pk if isinstance(value, Model) else value
+
+
+def pk_collection(values):
+    return collection(pk_value(value) for value in values)
+
+
+def pk_range(values):
+    return tuple(pk_value(value) for value in values)
+
+
+# The source used for each lookup, with the value preparation it needs.
+# Nulls never match a comparison, like in SQL.
+LOOKUPS = {
+    'exact': ('%(attr)s == %(value)s', None),
+    'iexact': ('%(attr)s.lower() == %(value)s', lower),
+    'contains': ('%(value)s in %(attr)s', None),
+    'icontains': ('%(value)s in %(attr)s.lower()', lower),
+    'in': ('%(attr)s in %(value)s', collection),
+    'gt': ('%(attr)s is not None and %(attr)s > %(value)s', None),
+    'gte': ('%(attr)s is not None and %(attr)s >= %(value)s', None),
+    'lt': ('%(attr)s is not None and %(attr)s < %(value)s', None),
+    'lte': ('%(attr)s is not None and %(attr)s <= %(value)s', None),
+    'range': ('%(attr)s is not None and %(value)s[0] <= %(attr)s <= %(value)s[1]', tuple),
+    'startswith': ('%(attr)s is not None and %(attr)s.startswith(%(value)s)', None),
+    'istartswith': ('%(attr)s is not None and %(attr)s.lower().startswith(%(value)s)', lower),
+    'endswith': ('%(attr)s is not None and %(attr)s.endswith(%(value)s)', None),
+    'iendswith': ('%(attr)s is not None and %(attr)s.lower().endswith(%(value)s)', lower),
+    'isnull': ('(%(attr)s is None) == %(value)s', bool),
+}
+# Lookups which can be answered from an index, rather than a scan.
+INDEXED_LOOKUPS = frozenset([
+    'exact', 'in', 'gt', 'gte', 'lt', 'lte', 'range', 'startswith', 'isnull',
+])
+# How each lookup maps on to the pk of a related object.
+PK_PREPARE = {
+    'exact': pk_value,
+    'in': pk_collection,
+    'gt': pk_value,
+    'gte': pk_value,
+    'lt': pk_value,
+    'lte': pk_value,
+    'range': pk_range,
+}
+# Lookups which treat the field as text, with the preparation they need for
+# fields which aren't.
+TEXT_LOOKUPS = {
+    'iexact': lower_text,
+    'contains': text,
+    'icontains': lower_text,
+    'startswith': text,
+    'istartswith': lower_text,
+    'endswith': text,
+    'iendswith': lower_text,
+}
+IDENTIFIER = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+
+
+def date_part(name):
+    """Make a function giving part of a date, or None for no date at all."""
+    def part(value):
+        return None if value is None else getattr(value, name)
+    return part
+
+
+def week_day(value):
+    """The day of the week as Django counts them, from 1 for Sunday."""
+    return None if value is None else value.isoweekday() % 7 + 1
+
+
+# The parts of a date field which lookups can compare in place of the date.
+DATE_TRANSFORMS = {
+    'year': date_part('year'),
+    'month': date_part('month'),
+    'day': date_part('day'),
+    'week_day': week_day,
+}
+plan_cache = {}
+
+
+def q_structure(q_object, values):
+    """Split a Q object into its shape and its values.
+
+    The shape is a hashable tuple of (connector, negated, children) where each
+    child is either another shape or a lookup key. The values of the lookups
+    are appended to `values` in the order they appear.
+    """
+    children = []
+    for child in q_object.children:
+        if isinstance(child, Node):
+            children.append(q_structure(child, values))
+        else:
+            key, value = child
+            children.append(key)
+            values.append(value)
+    return (q_object.connector, q_object.negated, tuple(children))
+
+
+# Matches every row, but only because we don't know any better.
+EVERYTHING = (frozenset(), True, False)
+
+
+def combine_pks(connector, results):
+    """Combine the pk sets found for the children of a node.
+
+    Each result is a tuple of (pks, complement, exact). The matching pks are
+    `pks`, or every pk but those if `complement` is set, so that negation
+    doesn't need to know about the whole table. Unless `exact` is set the
+    pks are only a superset of the matches.
+    """
+    exact = all(result[2] for result in results)
+    positive = sorted((pks for pks, complement, _ in results if not complement), key=len)
+    negative = sorted((pks for pks, complement, _ in results if complement), key=len)
+    if connector == 'OR':
+        # Swap things round so we can treat it as an AND. Or rather, as a
+        # NOT (NOT a AND NOT b).
+        positive, negative = negative, positive
+    if positive:
+        pks = set(positive[0])
+        for other in positive[1:]:
+            if not pks:
+                break
+            pks.intersection_update(other)
+        for other in negative:
+            if not pks:
+                break
+            pks.difference_update(other)
+        complement = False
+    else:
+        pks = set()
+        for other in negative:
+            pks.update(other)
+        complement = True
+    if connector == 'OR':
+        complement = not complement
+    return pks, complement, exact
+
+
+def hashed(tree):
+    """Whether an index tree has to match an exact or in lookup at its top level."""
+    if tree is None or tree[0] == 'm2m':
+        return False
+    if tree[0] == 'leaf':
+        return tree[3] in ('exact', 'in')
+    _, connector, negated, children = tree
+    return connector == 'AND' and not negated and any(hashed(child) for child in children)
+
+
+def get_plan(model, structure):
+    """Get the compiled plan for a Q object shape, compiling it if need be."""
+    try:
+        return plan_cache[(model, structure)]
+    except KeyError:
+        plan = plan_cache[(model, structure)] = Plan(model, structure)
+        return plan
+
+
+class Plan(object):
+    """A Q object shape compiled down to a single predicate.
+
+    The predicate is generated as Python source, with connectors and negation
+    turned into `and`, `or` and `not`. It is called with a row and the
+    prepared lookup values, so one plan serves every query of the same shape
+    whatever the values.
+
+    The top level of the shape is an AND of conditions. Alongside the full
+    predicate we keep an index tree for each condition, which `Query` can
+    evaluate as set operations on pks, and a residual predicate which only
+    checks the conditions that can't be answered that way.
+    """
+    def __init__(self, model, structure):
+        self.model = model
+        self.prepare = []
+        self.index_trees = []
+        self.complete = []
+        self.unindexed = 0
+        self.relations = []
+        self.joins = False
+        self.namespace = {'get_relation': get_relation, 'text': text}
+        connector, negated, children = structure
+        parts = []
+        residual = []
+        for child in children:
+            source, tree, complete = self._compile(child)
+            parts.append(source)
+            if not complete:
+                residual.append(source)
+            self.index_trees.append(tree)
+            self.complete.append(complete)
+        self.predicate = self._define('predicate', parts)
+        self.residual = self._define('residual', residual) if residual else None
+
+    def bind(self, values):
+        """Prepare the raw lookup values for use with the predicate."""
+        return [
+            prepare(value) if prepare else value
+            for prepare, value in zip(self.prepare, values)
+        ]
+
+    def _define(self, name, parts):
+        source = 'def %s(o, v):\n    return %s\n' % (name, ' and '.join(parts) or 'True')
+        exec(compile(source, '<plan for %s>' % self.model.__name__, 'exec'), self.namespace)
+        return self.namespace[name]
+
+    def _compile(self, child):
+        if isinstance(child, tuple):
+            return self._compile_node(child)
+        return self._compile_leaf(child)
+
+    def _compile_node(self, structure):
+        """Compile a node of the shape.
+
+        Returns the source for the node, its index tree (or None if none of it
+        is indexed) and whether every lookup in it can use an index.
+        """
+        connector, negated, children = structure
+        if not children:
+            return 'True', None, False
+        parts = []
+        trees = []
+        complete = True
+        for child in children:
+            source, tree, child_complete = self._compile(child)
+            parts.append(source)
+            trees.append(tree)
+            complete = complete and child_complete
+        source = '(%s)' % (' and ' if connector == 'AND' else ' or ').join(parts)
+        if negated:
+            source = '(not %s)' % source
+        if not any(trees):
+            return source, None, False
+        return source, ('node', connector, negated, trees), complete
+
+    def _compile_leaf(self, key):
+        source, tree, complete = self._compile_lookup(key)
+        if tree is None:
+            self.unindexed += 1
+        return source, tree, complete
+
+    def _compile_lookup(self, key):
+        position = len(self.prepare)
+        value = 'v[%d]' % position
+        parts = key.split(LOOKUP_SEP)
+        lookup = parts.pop() if len(parts) > 1 and parts[-1] in LOOKUPS else 'exact'
+        template, prepare = LOOKUPS[lookup]
+        attr = '%s'
+        if len(parts) > 1 and parts[-1] in DATE_TRANSFORMS and self._date_field(parts[:-1]):
+            # Comparing part of a date, which no index can help with.
+            self.namespace['transform_%d' % position] = DATE_TRANSFORMS[parts.pop()]
+            attr = 'transform_%d(%%s)' % position
+        m2m = get_m2m_field(self.model, parts[0])
+        if m2m is not None and len(parts) <= 2 and lookup in ('exact', 'in'):
+            field, direction = m2m
+            if len(parts) == 1 or parts[1] in ('pk', field.rel.to._meta.pk.name, self.model._meta.pk.name):
+                return self._compile_m2m(position, field, direction, lookup)
+        field = get_concrete_field(self.model, parts[0])
+        if len(parts) == 2 and field is not None and field.rel:
+            # fk__pk is the same as fk, and can use the foreign key's index.
+            if parts[1] in ('pk', field.rel.get_related_field().name):
+                parts.pop()
+        if len(parts) == 1 and field is not None:
+            if field.rel or field.primary_key:
+                prepare = PK_PREPARE.get(lookup, prepare)
+            attr, prepare = self._text(field, lookup, attr, prepare)
+            self.prepare.append(prepare)
+            source = template % {'attr': attr % ('o.%s' % field.attname), 'value': value}
+            if lookup in INDEXED_LOOKUPS and attr == '%s':
+                return source, ('leaf', position, field.attname, lookup), True
+            return source, None, False
+        if (len(parts) == 1 and IDENTIFIER.match(parts[0]) and
+                get_accessor(self.model, parts[0], query_name=True) is None):
+            # Any other name on its own, like an annotation, is an attribute.
+            self.prepare.append(prepare)
+            return template % {'attr': attr % ('o.%s' % parts[0]), 'value': value}, None, False
+        # Following relations can reach any number of objects, like a join,
+        # so the lookup matches if any of their values do. Where there are
+        # none we test a null, as an outer join would, but only for isnull.
+        steps, model, field = resolve_lookup(self.model, parts)
+        if field is None or field.rel or field.primary_key:
+            prepare = PK_PREPARE.get(lookup, prepare)
+        attr, prepare = self._text(field or model._meta.pk, lookup, attr, prepare)
+        self.prepare.append(prepare)
+        name = 'leaf_%d' % position
+        self.joins = True
+        self.namespace['source_%d' % position] = aggregate_source(self.model, LOOKUP_SEP.join(parts))
+        source = (
+            'def %(name)s(o, v):\n'
+            '    values = source_%(position)d(o)\n'
+            '    if not values:\n'
+            '        return %(empty)s\n'
+            '    return any(%(test)s for o in values)\n'
+        ) % {
+            'name': name,
+            'position': position,
+            'empty': template % {'attr': 'None', 'value': value} if lookup == 'isnull' else 'False',
+            'test': template % {'attr': attr % 'o', 'value': value},
+        }
+        exec(compile(source, '<plan for %s>' % self.model.__name__, 'exec'), self.namespace)
+        return '%s(o, v)' % name, None, False
+
+    def _text(self, field, lookup, attr, prepare):
+        """Cast the values of a field which isn't text for a text lookup.
+
+        Returns the source for the attribute and the value preparation to use.
+        The cast values are in no index, so the lookup is checked row by row.
+        """
+        if lookup not in TEXT_LOOKUPS or (attr == '%s' and isinstance(field, (CharField, TextField))):
+            return attr, prepare
+        return 'text(%s)' % attr, TEXT_LOOKUPS[lookup]
+
+    def _date_field(self, parts):
+        """Whether a lookup's names lead to a date field, for a transform to follow."""
+        try:
+            field = resolve_lookup(self.model, parts)[2]
+        except FieldError:
+            return False
+        return isinstance(field, DateField)
+
+    def _compile_m2m(self, position, field, direction, lookup):
+        """Compile a lookup on the pks of a many to many relation.
+
+        The index tree looks the values up in one direction of the relation,
+        while the predicate checks the row's own related pks in the other.
+        """
+        self.prepare.append(pk_collection if lookup == 'in' else pk_value)
+        relation = (field.rel.through, field.m2m_field_name())
+        self.relations.append(relation)
+        self.namespace['relation_%d' % position] = relation
+        other = 'reverse' if direction == 'forward' else 'forward'
+        related = 'get_relation(*relation_%d).%s.get(o.%s, ())' % (position, other, self.model._meta.pk.attname)
+        if lookup == 'in':
+            source = '(not frozenset(%s).isdisjoint(v[%d]))' % (related, position)
+        else:
+            source = '(v[%d] in %s)' % (position, related)
+        return source, ('m2m', position, relation, direction, lookup), True
+
+
+def record(model, name, amount=1):
+    """Instrumentation hook, passing counts on to any active recorders."""
+    for recorder in context.recorders:
+        recorder.counts[model][name] += amount
+
+
+def counted(model, name, rows):
+    """Pass rows through, recording how many went by."""
+    for row in rows:
+        record(model, name)
+        yield row
+
+
+class QueryRecorder(object):
+    """Counts the work done by the data store while it is active.
+
+    Use as a context manager. Counts are kept per model, for:
+
+    * executes: queries run against the store, including for update and delete
+    * scanned: rows looked at by the filters
+    * returned: rows which came out of queries
+    * index_hits, index_misses: lookups which could or couldn't use an index
+    * sorts: queries which had to sort their results
+    * creates, updates, deletes: rows written
+    * cache_hits: results which came from a `ResultCache`
+    * masks: queries filtered with masks over the columns of a columnar table
+
+    Nothing is counted when there are no recorders, so this costs nothing
+    unless you're using it.
+    """
+    def __init__(self):
+        self.counts = defaultdict(Counter)
+
+    def __enter__(self):
+        context.recorders.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        context.recorders.remove(self)
+
+    def total(self, name, model=None):
+        if model is not None:
+            return self.counts[model][name]
+        return sum(counts[name] for counts in self.counts.values())
+
+    @property
+    def queries(self):
+        """The number of queries executed, counting each create as one."""
+        return self.total('executes') + self.total('creates')
+
+
+class ResultCache(object):
+    """Keeps the results of queries while it is active, to save running them again.
+
+    Use as a context manager. Results are keyed on the fingerprint of a query,
+    which takes in the versions of the tables and relations it reads, so any
+    write to those means the query is run afresh. Queries which follow
+    foreign keys to other tables aren't cached at all. The least recently
+    used results are dropped once there are more than `maxsize`.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __enter__(self):
+        context.result_caches.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        context.result_caches.remove(self)
+
+    def get(self, key):
+        """Get the results for a fingerprint, raising KeyError if there are none."""
+        try:
+            results = self.results.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        self.results[key] = results
+        self.hits += 1
+        return results
+
+    def put(self, key, results):
+        self.results[key] = results
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+    def clear(self):
+        self.results.clear()
+
+
+class Link(object):
+    """A link in a persistent chain, which clones of a query share.
+
+    Adding to a chain makes a new link pointing back at the old one, so the
+    old chain is left as it was and costs nothing to copy.
+    """
+    __slots__ = ('item', 'parent', 'length')
+
+    def __init__(self, item, parent=None):
+        self.item = item
+        self.parent = parent
+        self.length = 1 if parent is None else parent.length + 1
+
+    def __iter__(self):
+        items = []
+        link = self
+        while link is not None:
+            items.append(link.item)
+            link = link.parent
+        return reversed(items)
+
+    def ancestor(self, length):
+        """The link `length` items along the chain, counting from the start."""
+        link = self
+        while link is not None and link.length > length:
+            link = link.parent
+        return link
+
+
+class Descending(object):
+    """Wraps part of a sort key so that it sorts in reverse."""
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __ne__(self, other):
+        return self.value != other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __gt__(self, other):
+        return other.value > self.value
 
 
 class Query(object):
     """A replacement for Django's sql.Query object.
 
-    Shares a similar API to django.db.models.sql.Query. It has its own data store.
-    """
-    def __init__(self, model, where=None):
-        self.model = model
-        data_store.setdefault(model, [])
-        self.data_store = data_store[model]
-        self.counter = len(self.data_store) + 1
-        self.high_mark = None
-        self.low_mark = 0
-        self.where = []
-        self.ordering = None
-        self._empty = False
+    Shares a similar API to django.db.models.sql.Query. It has its own data store.
+
+    The filters are kept as a `Link` chain of (shape, values) pairs, one for
+    each call to add_q, and everything else is replaced rather than changed
+    in place, so a clone can share the lot with its parent.
+    """
+    def __init__(self, model, where=None):
+        self.model = model
+        self.data_store = get_table(model)
+        self.high_mark = None
+        self.low_mark = 0
+        self.where = None
+        self._plan = None
+        self._indexed = None
+        self.ordering = None
+        self.order_by = ()
+        self.select_related = False
+        self.aggregates = OrderedDict()
+        self.aggregate_filters = {}
+        self.group_by = None
+        self.projection = None
+        self.distinct = False
+        self.distinct_fields = []
+        self._empty = False
+
+    def execute(self):
+        """Execute a query against the data store.
+
+        Returns a list of the stored rows, so that they can be changed.
+        """
+        return list(self.iterate(project=False, materialize=False))
+
+    def iterate(self, ordered=True, project=True, materialize=True):
+        """Lazily execute a query against the data store.
+
+        Rows are pulled through the filters one at a time, and we stop as soon
+        as the slice is full. Ordering needs every matching row so it still
+        has to sort, but callers who don't care about the order can skip that
+        unless the query is sliced. Projections for values() are made from the
+        stored rows as they go past, unless `project` is False.
+
+        Rows from a compact table are only made into model instances at the
+        end, if `materialize` is set. Annotated rows are always copies.
+        """
+        if self._empty:
+            return iter(())
+        plan, values = self.get_plan()
+        rows, predicate = self._candidates(plan, values)
+        if context.recorders:
+            record(self.model, 'executes')
+            record(self.model, 'index_misses', plan.unindexed)
+            rows = counted(self.model, 'scanned', rows)
+        annotations = self._aggregate_sources(summary=False) if self.aggregates else None
+        materialized = not self.data_store.compact
+        if annotations and self.group_by is None:
+            # The annotations go on instances of our own, not the stored rows.
+            rows = self._annotate(imap(self.data_store.detach, rows), annotations)
+            materialized = True
+        if predicate is not None:
+            rows = (row for row in rows if predicate(row, values))
+        if self.group_by is not None:
+            rows = self._group(rows, annotations or [])
+        project = project and self.projection is not None
+        distinct = project and self.distinct
+        sliced = self.low_mark or self.high_mark is not None
+        if self.ordering and (ordered or sliced):
+            if context.recorders:
+                record(self.model, 'sorts')
+            key, reverse = self.ordering
+            if self.high_mark is not None and not distinct:
+                # Only the top of the pile is wanted, so keep a heap of that.
+                select = heapq.nlargest if reverse else heapq.nsmallest
+                rows = select(self.high_mark, rows, key=key)
+            else:
+                rows = sorted(rows, key=key, reverse=reverse)
+        if project:
+            rows = self._project(rows)
+            if distinct:
+                rows = self._distinct(rows)
+        else:
+            if materialize and not materialized and self.group_by is None:
+                rows = imap(self.data_store.materialize, rows)
+                materialized = True
+            if self.select_related and materialized:
+                rows = self._select_related(rows)
+        if sliced:
+            rows = islice(rows, self.low_mark, self.high_mark)
+        if context.recorders:
+            rows = counted(self.model, 'returned', rows)
+        return iter(rows)
+
+    def _group(self, rows, annotations):
+        """Collapse rows into a `Group` for each value of the group_by fields.
+
+        The annotations are worked out for each group rather than each row.
+        """
+        sources = [aggregate_source(self.model, name) for name in self.group_by]
+        attnames = []
+        for name in self.group_by:
+            field = get_concrete_field(self.model, name)
+            attnames.append(field.attname if field is not None and field.attname != name else None)
+
+        def keys(row):
+            return product(*[source(row) or (None,) for source in sources])
+
+        for key, results in aggregate_rows(rows, annotations, keys).iteritems():
+            group = Group(results)
+            for name, attname, value in zip(self.group_by, attnames, key):
+                setattr(group, name, value)
+                if attname is not None:
+                    setattr(group, attname, value)
+            yield group
+
+    def _project(self, rows):
+        """Turn rows into the dicts, tuples or values asked for by values().
+
+        Plain fields are read straight off the rows with a single attrgetter.
+        Anything following a relation has to cope with any number of values,
+        giving a result for each combination as a join would.
+        """
+        names, kind = self.projection
+        attnames = []
+        for name in names:
+            if self.group_by is not None or name in self.aggregates:
+                attnames.append(name)
+                continue
+            field = get_concrete_field(self.model, name)
+            if field is None:
+                return self._project_related(rows, names, kind)
+            attnames.append(field.attname)
+        get = attrgetter(*attnames)
+        if kind == 'flat':
+            return (get(row) for row in rows)
+        if len(names) == 1:
+            if kind == 'tuple':
+                return ((get(row),) for row in rows)
+            name = names[0]
+            return ({name: get(row)} for row in rows)
+        if kind == 'tuple':
+            return (get(row) for row in rows)
+        return (dict(zip(names, get(row))) for row in rows)
+
+    def _project_related(self, rows, names, kind):
+        sources = [
+            (lambda row, get=attrgetter(name): (get(row),)) if name in self.aggregates
+            else aggregate_source(self.model, name)
+            for name in names
+        ]
+        for row in rows:
+            for values in product(*[source(row) or (None,) for source in sources]):
+                if kind == 'flat':
+                    yield values[0]
+                elif kind == 'tuple':
+                    yield values
+                else:
+                    yield dict(zip(names, values))
+
+    def _distinct(self, rows):
+        names, kind = self.projection
+        seen = set()
+        for row in rows:
+            key = tuple(row[name] for name in names) if kind == 'dict' else row
+            if key not in seen:
+                seen.add(key)
+                yield row
+
+    def _annotate(self, rows, annotations):
+        """Set each annotation on the rows as an attribute, as Django does."""
+        for row in rows:
+            for alias, source, aggregate in annotations:
+                accumulator = make_accumulator(aggregate)
+                for value in source(row):
+                    accumulator.add(value)
+                setattr(row, alias, accumulator.result())
+            yield row
+
+    def _aggregate_sources(self, summary):
+        sources = []
+        for alias, (aggregate, is_summary) in self.aggregates.items():
+            if is_summary == summary:
+                if aggregate.lookup in self.aggregates:
+                    source = lambda row, get=attrgetter(aggregate.lookup): (get(row),)
+                else:
+                    source = self._joined_source(aggregate.lookup, self.aggregate_filters.get(alias))
+                sources.append((alias, source, aggregate))
+        return sources
+
+    def _joined_source(self, lookup, where):
+        """The source of an aggregate, keeping to the related rows filtered on.
+
+        In SQL an aggregate across a relation which can reach many rows uses
+        the same join as the filters on it, so only the related rows which
+        passed them are counted.
+        """
+        prefix = multi_valued_prefix(self.model, lookup.split(LOOKUP_SEP))
+        if prefix is None or where is None:
+            return aggregate_source(self.model, lookup)
+        conditions, ambiguous = join_conditions(self.model, where)
+        if prefix in ambiguous:
+            raise NotImplementedError(
+                "Aggregating over %r, which is filtered on in more than one "
+                "call to filter() or under an OR, isn't supported." % LOOKUP_SEP.join(prefix))
+        if prefix not in conditions:
+            return aggregate_source(self.model, lookup)
+        steps, model, _ = resolve_lookup(self.model, prefix)
+        keys, values = zip(*conditions[prefix])
+        plan = get_plan(model, (Q.AND, False, keys))
+        predicate, bound = plan.predicate, plan.bind(values)
+        rest = aggregate_source(model, lookup[len(LOOKUP_SEP.join(prefix)) + len(LOOKUP_SEP):] or 'pk')
+
+        def source(row):
+            objs = [row]
+            for kind, field in steps:
+                objs = [related for obj in objs for related in related_rows(obj, kind, field)]
+            return [value for obj in objs if predicate(obj, bound) for value in rest(obj)]
+        return source
+
+    def _select_related(self, rows):
+        for row in rows:
+            select_related_objects(row, self.select_related)
+            yield row
+
+    def _candidates(self, plan, values):
+        """Find the rows which could match the current query.
+
+        The indexed conditions are evaluated as set operations on pks, which
+        gives us the candidate rows. Returns those along with the predicate
+        which still needs to run over them: just the residual conditions if
+        the indexes answered everything they were asked, otherwise the lot.
+
+        The combined result is kept along with the filters it was worked out
+        for, so a clone with more filters only has to evaluate the new ones
+        as long as nothing it reads has been written to since.
+
+        Columnar tables are filtered with masks instead, where they can be.
+        """
+        if self.data_store.columnar:
+            masked = self._masked(plan, values)
+            if masked is not None:
+                mask, predicate = masked
+                return self.data_store.columns().select(mask), predicate
+        results = []
+        answered = True
+        start = 0
+        if self._indexed is not None:
+            link, stamps, result, prefix_answered = self._indexed
+            if (self.where.ancestor(link.length) is link and
+                    all(store.version == version for store, version in stamps)):
+                results.append(result)
+                answered = prefix_answered
+                start = link.length
+        trees = zip(plan.index_trees, plan.complete)
+        for tree, complete in islice(trees, start, None):
+            result = self._evaluate(tree, values)
+            results.append(result)
+            if complete and not result[2]:
+                answered = False
+        pks, complement, exact = combine_pks('AND', results)
+        if self.where is not None:
+            stores = [self.data_store]
+            stores.extend(get_relation(*relation) for relation in plan.relations)
+            stamps = tuple((store, store.version) for store in stores)
+            self._indexed = self.where, stamps, (pks, complement, exact), answered
+        predicate = plan.residual if answered else plan.predicate
+        if not complement:
+            return self.data_store.fetch(pks), predicate
+        return self.data_store.rows(exclude=pks), predicate
+
+    def _masked(self, plan, values):
+        """Evaluate the filters as NumPy masks over the columns of the table.
+
+        Returns (mask, predicate) as `_candidates` would, with the mask in
+        place of the rows. Returns None if there's nothing to mask, or if any
+        condition is an equality the hash indexes can answer straight away.
+        """
+        if self.where is None:
+            return None
+        trees = plan.index_trees
+        if any(hashed(tree) for tree in trees):
+            return None
+        columns = self.data_store.columns()
+        mask = None
+        answered = True
+        for tree, complete in zip(trees, plan.complete):
+            result, exact = self._mask(columns, tree, values)
+            if result is not None:
+                mask = result if mask is None else mask & result
+            if complete and not exact:
+                answered = False
+        if mask is None:
+            return None
+        if context.recorders:
+            record(self.model, 'masks')
+        return mask, plan.residual if answered else plan.predicate
+
+    def _mask(self, columns, tree, values):
+        """Evaluate an index tree as a mask over the columns.
+
+        Returns (mask, exact), with the mask None for every row. Unless
+        `exact` is set the mask only gives a superset of the matches, as with
+        `combine_pks`.
+        """
+        if tree is None or tree[0] == 'm2m':
+            return None, False
+        if tree[0] == 'leaf':
+            _, position, attname, lookup = tree
+            mask = columns.mask(attname, lookup, values[position])
+            return mask, mask is not None
+        _, connector, negated, children = tree
+        results = [self._mask(columns, child, values) for child in children]
+        exact = all(result[1] for result in results)
+        masks = [mask for mask, _ in results if mask is not None]
+        if not masks or (connector == 'OR' and len(masks) < len(results)):
+            return None, False
+        mask = reduce(numpy.logical_and if connector == 'AND' else numpy.logical_or, masks)
+        if negated:
+            if not exact:
+                return None, False
+            return ~mask, True
+        return mask, exact
+
+    def _masked_count(self):
+        """Count the matching rows from the masks, or None if they can't tell us."""
+        if not self.data_store.columnar or self.aggregates:
+            return None
+        plan, values = self.get_plan()
+        masked = self._masked(plan, values)
+        if masked is None or masked[1] is not None:
+            return None
+        return int(numpy.count_nonzero(masked[0]))
+
+    def _masked_aggregation(self, summaries):
+        """Work out the summary aggregates from the columns, or None if we can't.
+
+        Only aggregates of this model's own fields, over queries whose filters
+        the masks answer completely, are worked out this way.
+        """
+        if (self.aggregates or self._empty or self.group_by is not None or self.distinct or
+                self.low_mark or self.high_mark is not None):
+            return None
+        attnames = []
+        for alias, source, aggregate in summaries:
+            if aggregate.name not in ACCUMULATORS:
+                return None
+            if aggregate.lookup == '*' and aggregate.name == 'Count':
+                attnames.append(None)
+                continue
+            field = get_concrete_field(self.model, aggregate.lookup)
+            if field is None:
+                return None
+            attnames.append(field.attname)
+        mask = None
+        if self.where:
+            plan, values = self.get_plan()
+            masked = self._masked(plan, values)
+            if masked is None or masked[1] is not None:
+                return None
+            mask = masked[0]
+        if context.recorders:
+            record(self.model, 'executes')
+        columns = self.data_store.columns()
+        return dict(
+            (alias, column_aggregate(columns, attname, mask, aggregate))
+            for (alias, source, aggregate), attname in zip(summaries, attnames)
+        )
+
+    def _evaluate(self, tree, values):
+        """Evaluate an index tree as set operations on pks.
+
+        Returns (pks, complement, exact) as described in `combine_pks`.
+        """
+        if tree is None:
+            return EVERYTHING
+        if tree[0] in ('leaf', 'm2m'):
+            if tree[0] == 'm2m':
+                pks = self._m2m_lookup(*tree[1:] + (values,))
+            else:
+                _, position, attname, lookup = tree
+                pks = self._index_lookup(attname, lookup, values[position])
+            if context.recorders:
+                record(self.model, 'index_misses' if pks is None else 'index_hits')
+            if pks is None:
+                return EVERYTHING
+            return pks, False, True
+        _, connector, negated, children = tree
+        pks, complement, exact = combine_pks(connector, [
+            self._evaluate(child, values) for child in children
+        ])
+        if negated:
+            if not exact:
+                return EVERYTHING
+            return pks, not complement, True
+        return pks, complement, exact
+
+    def _m2m_lookup(self, position, relation, direction, lookup, values):
+        """Find the pks of rows related to the value(s) of a lookup."""
+        edges = getattr(get_relation(*relation), direction)
+        value = values[position]
+        if lookup == 'exact':
+            try:
+                return edges.get(value, ())
+            except TypeError:
+                return None
+        pks = set()
+        for value in value:
+            pks.update(edges.get(value, ()))
+        return pks
+
+    def _index_lookup(self, attname, lookup, value):
+        """Find the pks matching a single lookup from an index.
+
+        Returns None if the value can't be looked up in an index.
+        """
+        if lookup in ('exact', 'in', 'isnull'):
+            if lookup == 'exact':
+                values = [value]
+            elif lookup == 'in':
+                values = list(value)
+            elif value:
+                values = [None]
+            else:
+                return self.data_store.index(attname, SortedIndex).between()
+            try:
+                set(values)
+            except TypeError:
+                return None
+            return self.data_store.index(attname).lookup(values)
+        if value is None or (lookup == 'startswith' and not isinstance(value, basestring)):
+            return None
+        index = self.data_store.index(attname, SortedIndex)
+        if lookup == 'gt':
+            return index.between(low=value, include_low=False)
+        elif lookup == 'gte':
+            return index.between(low=value)
+        elif lookup == 'lt':
+            return index.between(high=value, include_high=False)
+        elif lookup == 'lte':
+            return index.between(high=value)
+        elif lookup == 'range':
+            return index.between(*value)
+        elif lookup == 'startswith':
+            return index.prefix(value)
+
+    def get_plan(self):
+        """Get the compiled plan and bound values for all our filters."""
+        if self._plan is None:
+            where = list(self.where or ())
+            structure = (Q.AND, False, tuple(shape for shape, values in where))
+            plan = get_plan(self.model, structure)
+            self._plan = plan, plan.bind([value for shape, values in where for value in values])
+        return self._plan
 
-    def execute(self):
-        """Execute a query against the data store.
+    def clone(self, klass=None, memo=None, **kwargs):
+        """Make a copy which can be changed without affecting this query.
 
-        Work on a copy of the list so we don't accidentally change the store.
-        """
-        data = self.data_store[:]
-        for func in self.where:
-            data = filter(func, data)
-        if self.ordering:
-            data = sorted(data, cmp=self.ordering)
-        if self.low_mark and not self.high_mark:
-            data = data[self.low_mark:]
-        elif self.high_mark:
-            data = data[self.low_mark:self.high_mark]
-        return data
-
-    def clone(self, *args, **kwargs):
-        """Trivial clone method."""
-        return self
+        Nothing is changed in place, so a shallow copy is enough, and the
+        clone starts off sharing our filters, compiled plan and candidates.
+        """
+        obj = Query.__new__(Query)
+        obj.__dict__.update(self.__dict__)
+        obj.__dict__.update(kwargs)
+        return obj
 
     def assign_pk(self, obj):
-        """Simple counter based "primary key" allocation."""
-        obj.pk = self.counter
-        self.counter += 1
+        """Simple counter based "primary key" allocation.
+
+        The counter lives on the table, and skips past any PKs which have been
+        set by hand.
+        """
+        obj.pk = self.data_store.next_pk()
 
     def create(self, obj):
         """Creates an object by adding it to the data store.
 
-        Will allocate a PK if one does not exist, but currently does nothing to
-        ensure uniqueness of your PKs if you've set one already.
+        Will allocate a PK if one does not exist. Raises IntegrityError if the
+        PK or any unique fields clash with an object already stored.
         """
         if not obj.pk:
             self.assign_pk(obj)
-        self.data_store.append(obj)
+        self.data_store.insert(obj)
+        if context.recorders:
+            record(self.model, 'creates')
+
+    def bulk_create(self, objs):
+        """Creates a batch of objects, with a block of PKs for those without."""
+        self.data_store.assign_pks(objs)
+        self.data_store.insert_many(objs)
+        if context.recorders:
+            record(self.model, 'creates', len(objs))
+
+    def in_bulk(self, pks):
+        """Find the objects for some PKs straight from the table."""
+        if context.recorders:
+            record(self.model, 'executes')
+        to_python = self.model._meta.pk.to_python
+        table = self.data_store
+        objs = {}
+        for pk in pks:
+            obj = table.get(to_python(pk))
+            if obj is not None:
+                objs[obj.pk] = table.materialize(obj)
+        return objs
 
     def delete(self):
-        """Removes objects from the data store."""
+        """Removes objects from the data store.
+
+        Their many to many edges go too, in both directions, as they would
+        with a cascade on the through table.
+        """
         items = self.execute()
+        relations = list(stored_relations(self.model))
         for item in items:
-            self.data_store.remove(item)
+            self.data_store.discard(item.pk)
+            for relation, forward in relations:
+                relation.clear(item.pk, forward=forward)
+        if context.recorders:
+            record(self.model, 'deletes', len(items))
 
     def update(self, **kwargs):
         """Updates the objects in the data store.
@@ -72,20 +2094,172 @@ class Query(object):
 
         Should models be faffing with setattr then this is likely to break
         things.
+
+        Should the update break a unique constraint, the rows are put back as
+        they were and IntegrityError raised. The stored rows may have been
+        changed before we were called, by save(), so the updated fields are
+        put back as the indexes last filed them.
         """
         data = self.execute()
+        table = self.data_store
+        attnames = set()
+        for key in kwargs:
+            field = get_concrete_field(self.model, key)
+            attnames.add(field.attname if field is not None else key)
+        states = [table.row_state(instance) for instance in data] if table.constrains(attnames) else None
+        batch = []
         for instance in data:
+            pk = table.stored_pk(instance)
             for key, value in kwargs.items():
                 setattr(instance, key, value)
+            batch.append((pk, instance))
+        try:
+            table.refresh_many(batch, attnames)
+        except IntegrityError:
+            for (pk, instance), state in zip(batch, states):
+                table.set_row_state(instance, state)
+                table.reset_row(pk, instance, attnames)
+            raise
+        if context.recorders:
+            record(self.model, 'updates', len(data))
         return len(data)
 
     def has_results(self, using=None):
         """Find out whether there's anything that matches the current query state."""
-        return bool(self.execute())
+        if self.where and not self._empty and self.group_by is None and not self.distinct:
+            count = self._masked_count()
+            if count is not None:
+                if context.recorders:
+                    record(self.model, 'executes')
+                return self._sliced(count) > 0
+        for row in self.iterate(ordered=False, materialize=False):
+            return True
+        return False
+
+    def results(self):
+        """Iterate over the results, from the active `ResultCache` if we can."""
+        if not context.result_caches:
+            return self.iterate()
+        key = self.fingerprint('results')
+        if key is None:
+            return self.iterate()
+        try:
+            results = context.result_caches[-1].get(key)
+        except KeyError:
+            results = list(self.iterate(materialize=False))
+            context.result_caches[-1].put(key, results)
+        else:
+            if context.recorders:
+                record(self.model, 'cache_hits')
+        if self.projection is None:
+            # The stored rows are kept, so a compact table makes new
+            # instances each time rather than sharing any unsaved changes.
+            return imap(self.data_store.materialize, results)
+        if self.projection[1] == 'dict':
+            # Dicts can be changed by whoever gets them, so hand out copies.
+            return (dict(row) for row in results)
+        return iter(results)
+
+    def fingerprint(self, kind):
+        """A hashable key for everything which decides the results of the query.
+
+        It includes the version of every store the query reads, so it changes
+        whenever they are written to. We give up and return None for queries
+        which follow relations to other tables, whether in their filters or
+        their ordering, or have unhashable values.
+        """
+        plan, values = self.get_plan()
+        if plan.joins or self.select_related or self.aggregates:
+            return None
+        if any(LOOKUP_SEP in name for name in self.order_by):
+            return None
+        if self.projection is not None:
+            for name in self.projection[0]:
+                if get_concrete_field(self.model, name) is None:
+                    return None
+        versions = [self.data_store.version]
+        versions.extend(get_relation(*relation).version for relation in plan.relations)
+        key = (
+            kind, plan, tuple(values), self.order_by, self.low_mark,
+            self.high_mark, self._empty, self.projection, self.distinct, tuple(versions),
+        )
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
 
     def get_count(self, using=None):
         """Find how many objects match the current query state."""
-        return len(self.execute())
+        if context.result_caches:
+            key = self.fingerprint('count')
+            if key is not None:
+                try:
+                    count = context.result_caches[-1].get(key)
+                except KeyError:
+                    count = self._count()
+                    context.result_caches[-1].put(key, count)
+                else:
+                    if context.recorders:
+                        record(self.model, 'cache_hits')
+                return count
+        return self._count()
+
+    def _count(self):
+        if not self._empty and self.group_by is None and not self.distinct:
+            count = self._masked_count() if self.where else len(self.data_store)
+            if count is not None:
+                if context.recorders:
+                    record(self.model, 'executes')
+                return self._sliced(count)
+        return sum(1 for row in self.iterate(ordered=False, materialize=False))
+
+    def _sliced(self, count):
+        """How many of `count` rows are left once the query is sliced."""
+        count = max(count - self.low_mark, 0)
+        if self.high_mark is not None:
+            count = min(count, self.high_mark - self.low_mark)
+        return count
+
+    def add_aggregate(self, aggregate, model, alias, is_summary):
+        """Note an aggregate to annotate each row with, or to summarise them.
+
+        The filters so far are kept with it, as those are the ones whose
+        joins it would be worked out over in SQL.
+        """
+        self.aggregates = OrderedDict(self.aggregates)
+        self.aggregates[alias] = aggregate, is_summary
+        self.aggregate_filters = dict(self.aggregate_filters)
+        self.aggregate_filters[alias] = self.where
+
+    def get_aggregation(self, using=None):
+        """Work out the summary aggregates in a single pass over the rows.
+
+        Django only ever asks a throwaway clone for these, so they're dropped
+        again once they're done.
+        """
+        summaries = self._aggregate_sources(summary=True)
+        self.aggregates = OrderedDict(
+            (alias, value) for alias, value in self.aggregates.iteritems() if not value[1]
+        )
+        if self.data_store.columnar:
+            results = self._masked_aggregation(summaries)
+            if results is not None:
+                return results
+        return aggregate_rows(self.iterate(ordered=False, project=False, materialize=False), summaries)
+
+    def set_projection(self, names, kind):
+        """Have rows come out as dicts, tuples or single values of some fields.
+
+        `kind` is one of 'dict', 'tuple' or 'flat'.
+        """
+        if kind == 'flat':
+            names = names[:1]
+        self.projection = tuple(names), kind
+
+    def add_distinct_fields(self, *field_names):
+        self.distinct_fields = field_names
+        self.distinct = True
 
     def set_limits(self, low=None, high=None):
         """Set limits for query slicing.
@@ -110,6 +2284,7 @@ class Query(object):
 
     def clear_ordering(self, force_empty=False):
         self.ordering = None
+        self.order_by = ()
 
     def set_empty(self):
         self._empty = True
@@ -118,66 +2293,804 @@ class Query(object):
         return self._empty
 
     def add_ordering(self, *fields):
-        """Create a compare function we can pass to `sorted` when we execute
-        the query."""
-
-        def compare(x, y):
-            for field in fields:
-                reverse = field.startswith('-')
-                if reverse:
-                    field = field[1:]
-                current = cmp(getattr(x, field), getattr(y, field))
-                if current is not 0:
-                    if reverse:
-                        return -current
-                    return current
-            return 0
-
-        self.ordering = compare
+        """Create a key function we can pass to `sorted` when we execute
+        the query.
+
+        If every field sorts the same way we can use a plain attrgetter and
+        let `sorted` do the reversing. Otherwise the descending parts of the
+        key are wrapped so they compare backwards.
+        """
+        if not fields:
+            return
+        self.order_by = fields
+        names = []
+        descending = []
+        for field in fields:
+            reverse = field.startswith('-')
+            if reverse:
+                field = field[1:]
+            parts = field.split(LOOKUP_SEP)
+            concrete = get_concrete_field(self.model, parts[0])
+            if concrete is not None and len(parts) == 1:
+                parts = [concrete.attname]
+            names.append('.'.join(parts))
+            descending.append(reverse)
+        key = attrgetter(*names)
+        if len(set(descending)) == 1:
+            self.ordering = key, descending[0]
+            return
+
+        def mixed_key(o):
+            return tuple(
+                Descending(value) if reverse else value
+                for value, reverse in zip(key(o), descending)
+            )
+        self.ordering = mixed_key, False
 
     def add_q(self, q_object):
-        """Add filter functions to be used in execute."""
-        for child in q_object.children:
-            if isinstance(child, Node):
-                self.add_q(child)
-            else:
-                self.where.append(self._get_filter_func(*child, negated=q_object.negated))
+        """Add a Q object's filters to be used in execute.
 
-    def _get_filter_func(self, key, value, negated=False):
-        func = None
-        if LOOKUP_SEP in key:
-            # This is horribly naive
-            key, lookup = key.split(LOOKUP_SEP, 1)
-            if lookup == 'exact':
-                pass
-            elif lookup == 'iexact':
-                func = lambda o: value.lower() == getattr(o, key).lower()
-            elif lookup == 'contains':
-                func = lambda o: value in getattr(o, key)
-            elif lookup == 'icontains':
-                func = lambda o: value.lower() in getattr(o, key).lower()
-            elif lookup == 'in':
-                func = lambda o: getattr(o, key) in value
+        Each call adds another condition which must hold, and the whole lot is
+        compiled into a single plan the next time we execute.
+        """
+        values = []
+        shape = q_structure(q_object, values)
+        self.where = Link((shape, tuple(values)), self.where)
+        self._plan = None
+
+    def add_select_related(self, fields):
+        """Note the foreign keys to follow, as a nested dict of field names."""
+        field_dict = {}
+        for field in fields:
+            d = field_dict
+            for part in field.split(LOOKUP_SEP):
+                d = d.setdefault(part, {})
+        self.select_related = field_dict
+
+
+MAX_RELATED_DEPTH = 5
+
+
+def follow_foreign_key(obj, field):
+    """Fill in the cache of a foreign key on `obj` straight from the store.
+
+    Returns the related object, or None if there isn't one to be found.
+    """
+    if isinstance(obj, Record):
+        return getattr(obj, field.name)
+    value = getattr(obj, field.attname)
+    if value is None:
+        setattr(obj, field.get_cache_name(), None)
+        return None
+    related = related_row(field, value)
+    if related is not None:
+        related = get_table(field.rel.to).materialize(related)
+        setattr(obj, field.get_cache_name(), related)
+    return related
+
+
+def related_row(field, value):
+    """Find the stored row a foreign key `field` with `value` points at, or None."""
+    if value is None:
+        return None
+    table = get_store().get(field.rel.to)
+    if table is None:
+        return None
+    target = field.rel.get_related_field()
+    if target.primary_key:
+        return table.get(value)
+    pks = table.index(target.attname).lookup([value])
+    return table[next(iter(pks))] if pks else None
+
+
+def select_related_objects(obj, fields, depth=1):
+    """Follow foreign keys from `obj` as Django's select_related() would.
+
+    `fields` is True to follow every foreign key which can't be null, or the
+    nested dict of field names built by `Query.add_select_related`.
+    """
+    for field in obj._meta.concrete_fields:
+        if not field.rel:
+            continue
+        if fields is True:
+            if field.null or depth > MAX_RELATED_DEPTH:
+                continue
+            follow = True
+        elif field.name in fields:
+            follow = fields[field.name]
+        else:
+            continue
+        related = follow_foreign_key(obj, field)
+        if related is not None and follow:
+            select_related_objects(related, follow, depth + 1)
+
+
+def prefetch_cache_name(manager):
+    """The key a related manager looks for in `_prefetched_objects_cache`."""
+    try:
+        return manager.prefetch_cache_name
+    except AttributeError:
+        # Reverse foreign key managers filter on the field pointing back.
+        name = next(iter(manager.core_filters)).split(LOOKUP_SEP)[0]
+        return manager.model._meta.get_field(name).related_query_name()
+
+
+def prefetch_related_objects(objs, lookups):
+    """Our own version of Django's prefetch_related_objects().
+
+    Each step of a lookup is a single pass over the objects found by the step
+    before, reading their related objects out of the indexes.
+    """
+    for lookup in OrderedDict.fromkeys(lookups):
+        current = objs
+        for name in lookup.split(LOOKUP_SEP):
+            if not current:
+                break
+            model = type(current[0])
+            accessor = get_accessor(model, name)
+            if accessor is None:
+                raise AttributeError(
+                    "Cannot find '%s' on %s object, '%s' is an invalid "
+                    "parameter to prefetch_related()" % (name, model.__name__, lookup))
+            current = prefetch_one_level(current, name, *accessor)
+
+
+def related_rows(obj, kind, field):
+    """Find the objects related to `obj` by a field, in storage order."""
+    if kind == 'fk':
+        related = follow_foreign_key(obj, field)
+        return [] if related is None else [related]
+    if kind == 'reverse_fk':
+        table = get_table(field.model)
+        value = getattr(obj, field.rel.get_related_field().attname)
+        return table.fetch(table.index(field.attname).lookup([value]))
+    relation = get_relation(field.rel.through, field.m2m_field_name())
+    if kind == 'm2m':
+        edges, table = relation.forward, get_table(field.rel.to)
+    else:
+        edges, table = relation.reverse, get_table(field.model)
+    return table.fetch(pk for pk in edges.get(obj.pk, ()) if pk in table)
+
+
+def prefetch_one_level(objs, name, kind, field):
+    """Prefetch one relation for some objects, returning the related objects."""
+    found = OrderedDict()
+    if kind == 'reverse_fk':
+        stores = [get_table(field.model)]
+    elif kind != 'fk':
+        model = field.rel.to if kind == 'm2m' else field.model
+        stores = [get_relation(field.rel.through, field.m2m_field_name()), get_table(model)]
+    for obj in objs:
+        rows = related_rows(obj, kind, field)
+        if kind != 'fk':
+            # Objects related to more than one of ours are only made once.
+            rows = [found[row.pk] if row.pk in found else stores[-1].materialize(row) for row in rows]
+        if kind == 'reverse_fk':
+            for row in rows:
+                setattr(row, field.get_cache_name(), obj)
+        if kind != 'fk':
+            cache_prefetched(obj, name, rows, stores)
+        found.update((row.pk, row) for row in rows)
+    return found.values()
+
+
+def cache_prefetched(obj, name, rows, stores):
+    """Give a related manager on `obj` some rows to return.
+
+    The stored objects are shared by every query, so the queryset remembers
+    which versions of the stores it came from. Should they change, it is
+    ignored and the rows are looked up again.
+    """
+    manager = getattr(obj, name)
+    try:
+        cache = obj._prefetched_objects_cache
+    except AttributeError:
+        cache = obj._prefetched_objects_cache = {}
+    queryset = QuerySet(manager.model).filter(**manager.core_filters)
+    queryset._result_cache = rows
+    queryset._prefetch_done = True
+    queryset._prefetched_from = [(store, store.version) for store in stores]
+    cache[prefetch_cache_name(manager)] = queryset
+
+
+def get_prefetched(manager):
+    """Find the queryset prefetched for a related manager, if still current."""
+    try:
+        queryset = manager.instance._prefetched_objects_cache[prefetch_cache_name(manager)]
+    except (AttributeError, KeyError):
+        return None
+    for store, version in getattr(queryset, '_prefetched_from', ()):
+        if store.version != version:
+            return None
+    return queryset
+
+
+class Accumulator(object):
+    """Works out an aggregate from values fed to it one at a time.
+
+    Nulls are skipped as they are in SQL, so the Sum of no values is None.
+    """
+    def __init__(self, distinct=False):
+        self.seen = set() if distinct else None
+        self.count = 0
+        self.value = None
+
+    def add(self, value):
+        if value is None:
+            return
+        if self.seen is not None:
+            if value in self.seen:
+                return
+            self.seen.add(value)
+        self.count += 1
+        self.combine(value)
+
+    def combine(self, value):
+        pass
+
+    def result(self):
+        return self.value
+
+
+class CountAccumulator(Accumulator):
+    def result(self):
+        return self.count
+
+
+class SumAccumulator(Accumulator):
+    def combine(self, value):
+        self.value = value if self.value is None else self.value + value
+
+
+class AvgAccumulator(SumAccumulator):
+    def result(self):
+        return float(self.value) / self.count if self.count else None
+
+
+class MinAccumulator(Accumulator):
+    def combine(self, value):
+        if self.value is None or value < self.value:
+            self.value = value
+
+
+class MaxAccumulator(Accumulator):
+    def combine(self, value):
+        if self.value is None or value > self.value:
+            self.value = value
+
+
+ACCUMULATORS = {
+    'Count': CountAccumulator,
+    'Sum': SumAccumulator,
+    'Avg': AvgAccumulator,
+    'Min': MinAccumulator,
+    'Max': MaxAccumulator,
+}
+
+
+def make_accumulator(aggregate):
+    try:
+        accumulator = ACCUMULATORS[aggregate.name]
+    except KeyError:
+        raise NotImplementedError("%s aggregates aren't supported in memory" % aggregate.name)
+    return accumulator(**aggregate.extra)
+
+
+def resolve_lookup(model, parts):
+    """Follow the names of a lookup from `model` across its relations.
+
+    Returns the (kind, field) steps taken, the model they end at and the
+    concrete field named last, or None where the lookup ends at a relation
+    and so stands for the related pks. A foreign key at the end is left as
+    its own value rather than followed.
+    """
+    steps = []
+    for position, name in enumerate(parts):
+        last = position == len(parts) - 1
+        accessor = get_accessor(model, name, query_name=True)
+        if accessor is not None and not (last and accessor[0] == 'fk'):
+            kind, field = accessor
+            steps.append(accessor)
+            model = field.rel.to if kind in ('fk', 'm2m') else field.model
+            continue
+        field = get_concrete_field(model, name)
+        if field is None or not last:
+            raise FieldError("Cannot resolve keyword %r into field. Choices are: %s" % (
+                name, ', '.join(sorted(model._meta.get_all_field_names()))))
+        return steps, model, field
+    return steps, model, None
+
+
+def multi_valued_prefix(model, parts):
+    """The names of a lookup up to the first relation which can reach many rows.
+
+    Returns them as a tuple, or None if the lookup never crosses one.
+    """
+    for position, name in enumerate(parts):
+        accessor = get_accessor(model, name, query_name=True)
+        if accessor is None:
+            return None
+        kind, field = accessor
+        if kind != 'fk':
+            return tuple(parts[:position + 1])
+        model = field.rel.to
+    return None
+
+
+def shape_leaves(shape, values, context=Q.AND):
+    """Pair up the lookups of a shape with their values from the `values` iterator.
+
+    Each comes with how it is reached: AND if only through ANDs, otherwise
+    OR if under an OR, or NOT if under a negation.
+    """
+    connector, negated, children = shape
+    if negated:
+        context = 'NOT'
+    elif connector == Q.OR and context == Q.AND and len(children) > 1:
+        context = Q.OR
+    for child in children:
+        if isinstance(child, tuple):
+            for leaf in shape_leaves(child, values, context):
+                yield leaf
+        else:
+            yield child, next(values), context
+
+
+def join_conditions(model, where):
+    """Find the filters applying to the rows reached across each relation.
+
+    Django joins a relation which can reach many rows once for each call to
+    filter() it is named in. Returns a dict of the conditions on the related
+    rows, as (lookup, value) pairs, by the names leading to the relation, and
+    the set of those names which are joined more than once or under an OR.
+    Excluded rows are left to subqueries in SQL, so don't restrict a join.
+    """
+    conditions = {}
+    ambiguous = set()
+    for shape, values in where:
+        found = {}
+        for key, value, context in shape_leaves(shape, iter(values)):
+            if context == 'NOT':
+                continue
+            parts = key.split(LOOKUP_SEP)
+            prefix = multi_valued_prefix(model, parts)
+            if prefix is None:
+                continue
+            if context == Q.OR or prefix in conditions:
+                ambiguous.add(prefix)
+                continue
+            rest = parts[len(prefix):]
+            if not rest or (len(rest) == 1 and rest[0] in LOOKUPS and
+                            get_concrete_field(resolve_lookup(model, prefix)[1], rest[0]) is None):
+                # A lookup on the relation itself is one on the related pks.
+                rest.insert(0, 'pk')
+            found.setdefault(prefix, []).append((LOOKUP_SEP.join(rest), value))
+        conditions.update(found)
+    return conditions, ambiguous
+
+
+source_cache = {}
+
+
+def aggregate_source(model, lookup):
+    """Make a function giving the values an aggregate's lookup has for a row.
+
+    Relations are followed the way joins would, so a row can have any number
+    of values. Where the lookup ends at a relation we take the related pks.
+    """
+    key = (model, lookup)
+    try:
+        return source_cache[key]
+    except KeyError:
+        pass
+    if lookup == '*':
+        source = lambda row: (True,)
+    else:
+        steps, model, field = resolve_lookup(model, lookup.split(LOOKUP_SEP))
+        get = attrgetter((field or model._meta.pk).attname)
+        if not steps:
+            source = lambda row: (get(row),)
+        else:
+            def source(row):
+                objs = [row]
+                for kind, field in steps:
+                    objs = [related for obj in objs for related in related_rows(obj, kind, field)]
+                return [get(obj) for obj in objs]
+    source_cache[key] = source
+    return source
+
+
+def aggregate_rows(rows, aggregates, keys=None):
+    """Work out aggregates over some rows in a single pass.
+
+    `aggregates` is a list of (alias, source, aggregate) triples. Without a
+    `keys` function we get a single dict of results. With one, each row goes
+    in the buckets for the keys it gives, and we get an OrderedDict of result
+    dicts by key.
+    """
+    buckets = OrderedDict()
+    for row in rows:
+        for bucket in keys(row) if keys is not None else (None,):
+            try:
+                accumulators = buckets[bucket]
+            except KeyError:
+                accumulators = buckets[bucket] = [
+                    (alias, source, make_accumulator(aggregate)) for alias, source, aggregate in aggregates
+                ]
+            for alias, source, accumulator in accumulators:
+                for value in source(row):
+                    accumulator.add(value)
+    results = OrderedDict(
+        (bucket, dict((alias, accumulator.result()) for alias, source, accumulator in accumulators))
+        for bucket, accumulators in buckets.iteritems()
+    )
+    if keys is not None:
+        return results
+    try:
+        return results[None]
+    except KeyError:
+        return dict((alias, make_accumulator(aggregate).result()) for alias, source, aggregate in aggregates)
+
+
+def column_aggregate(columns, attname, mask, aggregate):
+    """Work out an aggregate over the values of a column picked out by a mask.
+
+    Nulls are skipped as they are by the accumulators. An `attname` of None
+    counts the rows.
+    """
+    if attname is None:
+        return len(columns) if mask is None else int(numpy.count_nonzero(mask))
+    array, nulls = columns.column(attname)
+    values = array[~nulls if mask is None else mask & ~nulls]
+    if aggregate.extra.get('distinct'):
+        if values.dtype.kind == 'O':
+            distinct = list(set(values.tolist()))
+            values = numpy.empty(len(distinct), object)
+            values[:] = distinct
+        else:
+            values = numpy.unique(values)
+    name = aggregate.name
+    if name == 'Count':
+        return len(values)
+    if not len(values):
+        return None
+    if name == 'Sum':
+        return python_value(values.sum())
+    if name == 'Avg':
+        return float(python_value(values.sum())) / len(values)
+    return python_value(values.min() if name == 'Min' else values.max())
+
+
+def python_value(value):
+    """Turn a NumPy scalar back into the Python value it stands for."""
+    return value.item() if isinstance(value, numpy.generic) else value
+
+
+class Group(object):
+    """Stands in for the rows grouped together by values().annotate()."""
+    def __init__(self, attrs):
+        self.__dict__.update(attrs)
+
+
+class Snapshot(object):
+    """The contents of the data store at a point in time.
+
+    Every table and relation is captured up front, as rows are changed in
+    place before the store hears about it. Restoring only puts back those
+    which have been written to since, going by their versions, so untouched
+    ones cost nothing to restore. Changes made to stored objects without
+    saving them aren't seen as writes, and will survive a restore of an
+    otherwise untouched table.
+    """
+    def __init__(self, data_store=None):
+        self.data_store = get_store() if data_store is None else data_store
+        self.stores = {}
+        for key, store in self.data_store.items():
+            self.stores[key] = store, store.capture()
+
+    def restore(self):
+        data_store = self.data_store
+        with data_store.lock:
+            for key in data_store.keys():
+                if key not in self.stores:
+                    del data_store[key]
+            for key, (store, state) in self.stores.items():
+                if data_store.get(key) is not store:
+                    data_store[key] = store
+                    store.rollback(state)
+                elif store.version != state[-1]:
+                    store.rollback(state)
+
+
+def snapshot():
+    """Take a snapshot of the data store, to be put back with `restore()`."""
+    return Snapshot()
+
+
+def restore(snapshot):
+    """Put the data store back how it was when `snapshot` was taken."""
+    snapshot.restore()
+
+
+SNAPSHOT_FORMAT = 'test_db snapshot 2'
+INDEX_KINDS = {'HashIndex': HashIndex, 'SortedIndex': SortedIndex}
+
+
+def model_label(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+def meta_signature(models):
+    """A digest of the fields of some models, which changes whenever they do."""
+    description = []
+    for model in sorted(models, key=model_label):
+        opts = model._meta
+        description.append((model_label(model), opts.db_table, [
+            (field.name, field.attname, field.column, field.get_internal_type(),
+             model_label(field.rel.to) if field.rel else None)
+            for field in list(opts.concrete_fields) + list(opts.many_to_many)
+        ]))
+    return hashlib.sha1(repr(description)).hexdigest()
+
+
+def dump_store(path, data_store=None):
+    """Save the contents of a data store to a file, for `load_store()`.
+
+    Rows are saved without any cached related objects, and indexes by what
+    they index, to be rebuilt when loaded. The file starts with a signature
+    of the models it holds, so that it won't be loaded once they change.
+    """
+    store = get_store() if data_store is None else data_store
+    models = set()
+    tables = []
+    relations = []
+    for key, item in store.items():
+        if isinstance(item, Table):
+            models.add(item.model)
+            rows = [(pk, item.row_state(row, cached=False)) for pk, row in item.iteritems()]
+            indexes = [(kind.__name__, attname) for kind, attname in item.indexes]
+            tables.append((model_label(item.model), item.compact, item.counter, rows, indexes))
+        else:
+            models.add(item.through)
+            relations.append((model_label(item.through), item.source_name, item.forward))
+    with open(path, 'wb') as f:
+        f.write('%s\n%s\n%s\n' % (SNAPSHOT_FORMAT, meta_signature(models), ' '.join(sorted(model_label(model) for model in models))))
+        cPickle.dump((tables, relations), f, cPickle.HIGHEST_PROTOCOL)
+
+
+def load_store(path, data_store=None):
+    """Replace the contents of a data store with those saved by `dump_store()`.
+
+    The rows are unpickled straight from the file, with no creates replayed.
+    Returns False, leaving the store alone, if there's no file, the models
+    have changed since it was saved, or it was saved from a compact store
+    and this one isn't, or the other way round.
+    """
+    store = get_store() if data_store is None else data_store
+    try:
+        f = open(path, 'rb')
+    except IOError:
+        return False
+    with f:
+        if f.readline() != SNAPSHOT_FORMAT + '\n':
+            return False
+        signature = f.readline().rstrip('\n')
+        models = {}
+        for label in f.readline().split():
+            models[label] = get_model(*label.split('.', 1))
+        if None in models.values() or meta_signature(models.values()) != signature:
+            return False
+        tables, relations = cPickle.load(f)
+    if any(compact != store.compact for label, compact, counter, rows, indexes in tables):
+        return False
+    with store.lock:
+        store.clear()
+        for label, compact, counter, rows, indexes in tables:
+            model = models[label]
+            table = store[model] = store.make_table(model)
+            table.rollback(([(pk, table.blank_row(), state) for pk, state in rows], counter, next(versions)))
+            for kind, attname in indexes:
+                table.index(attname, INDEX_KINDS[kind])
+        for label, source_name, forward in relations:
+            relation = store[(models[label], source_name)] = Relation(models[label], source_name, store.lock)
+            relation.rollback((forward, next(versions)))
+    return True
+
+
+def load_or_populate(path, populate, data_store=None):
+    """Fill a data store from the snapshot at `path` if it is current.
+
+    Otherwise `populate()` is called to fill it, and a snapshot saved to
+    `path` for next time.
+    """
+    if not load_store(path, data_store):
+        populate()
+        dump_store(path, data_store)
+
+
+def find_fixture(name):
+    """Find a fixture file by path, or by name in the apps' fixture directories."""
+    if os.path.isfile(name):
+        return name
+    if not os.path.splitext(name)[1]:
+        name += '.json'
+    directories = [os.path.join(os.path.dirname(app.__file__), 'fixtures') for app in get_apps()]
+    directories.extend(settings.FIXTURE_DIRS)
+    for directory in directories:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    raise IOError("No fixture named '%s' found." % name)
+
+
+def iter_fixture(f, chunk_size=64 * 1024):
+    """Parse the objects of a JSON fixture one at a time.
+
+    The file is read in chunks, and each object is decoded as soon as all of
+    it has been read, so the whole file is never in memory at once.
+    """
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    eof = False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,[]':
+            position += 1
+        if position == len(buffer):
+            if eof:
+                return
+            buffer = f.read(chunk_size)
+            position = 0
+            eof = not buffer
+            continue
+        try:
+            obj, position = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                raise DeserializationError("Invalid JSON in fixture near %r" % buffer[position:position + 40])
+            more = f.read(chunk_size)
+            eof = not more
+            buffer = buffer[position:] + more
+            position = 0
+            continue
+        yield obj
+
+
+def load_fixture(fixture, batch_size=1000):
+    """Load a Django JSON fixture straight into the current data store.
+
+    Objects are built from their fields without being saved, and inserted a
+    batch at a time per model, replacing any rows with the same pks. Many to
+    many pks go straight into the relations. Returns the number of objects.
+    """
+    models = {}
+    batches = OrderedDict()
+    loaded = 0
+
+    def flush(model):
+        objs = batches.pop(model, None)
+        if objs:
+            table = get_table(model)
+            for obj in objs:
+                if obj.pk in table:
+                    table.discard(obj.pk)
+            Query(model).bulk_create(objs)
+
+    def related_pk(field, value):
+        model = field.rel.to
+        if isinstance(value, list):
+            # A natural key, which needs anything waiting to go in first.
+            for waiting in batches.keys():
+                flush(waiting)
+            return model._default_manager.get_by_natural_key(*value).pk
+        return field.rel.get_related_field().to_python(value)
+
+    with open(find_fixture(fixture), 'rb') as f:
+        for item in iter_fixture(f):
+            label = item['model']
+            try:
+                model = models[label]
+            except KeyError:
+                model = models[label] = get_model(*label.split('.', 1))
+                if model is None:
+                    raise DeserializationError("Invalid model identifier: '%s'" % label)
+            opts = model._meta
+            data = {}
+            if item.get('pk') is not None:
+                data[opts.pk.attname] = opts.pk.to_python(item['pk'])
+            edges = []
+            for name, value in item['fields'].iteritems():
+                field = opts.get_field(name)
+                if field in opts.many_to_many:
+                    edges.append((field, [related_pk(field, pk) for pk in value]))
+                elif field.rel:
+                    data[field.attname] = None if value is None else related_pk(field, value)
+                else:
+                    data[field.attname] = field.to_python(value)
+            obj = model(**data)
+            if not obj.pk:
+                flush(model)
+                Query(model).bulk_create([obj])
             else:
-                next_level_func = self._get_filter_func(lookup, value)
-                func = lambda o: next_level_func(getattr(o, key))
-        # FIXME: blatantly broken
-        if key == 'fan' or key == 'collaborations':
-            def func(o):
-                try:
-                    store = data_store[(self.model, key)]
-                except KeyError:
-                    return False
-                try:
-                    list = store[value]
-                except KeyError:
-                    return False
-                return o in list
-        if not func:
-            func = lambda o: getattr(o, key) == value
-        if negated:
-            return lambda o: not func(o)
-        return func
+                batch = batches.setdefault(model, [])
+                batch.append(obj)
+                if len(batch) >= batch_size:
+                    flush(model)
+            for field, pks in edges:
+                relation = get_relation(field.rel.through, field.m2m_field_name())
+                relation.clear(obj.pk)
+                for pk in pks:
+                    relation.add(obj.pk, pk)
+            loaded += 1
+    for model in batches.keys():
+        flush(model)
+    return loaded
+
+
+class SnapshotTestMixin(object):
+    """Gives test cases savepoint semantics over the data store.
+
+    Objects loaded from `memory_fixtures` and created in `setUpTestData` are
+    set up once per class, and the data store is rolled back to that state
+    after each test. The data store is cleared out once the class has
+    finished.
+    """
+    memory_fixtures = ()
+
+    @classmethod
+    def setUpClass(cls):
+        super(SnapshotTestMixin, cls).setUpClass()
+        for fixture in cls.memory_fixtures:
+            load_fixture(fixture)
+        cls.setUpTestData()
+        cls._snapshot = snapshot()
+
+    @classmethod
+    def tearDownClass(cls):
+        get_store().clear()
+        super(SnapshotTestMixin, cls).tearDownClass()
+
+    @classmethod
+    def setUpTestData(cls):
+        """Create objects to be shared by all the tests in the class."""
+
+    def tearDown(self):
+        restore(self._snapshot)
+        super(SnapshotTestMixin, self).tearDown()
+
+
+class MemoryAssertionsMixin(object):
+    """Assertions about how much work the data store has done.
+
+    Like `assertNumQueries`, these can be used as context managers or be
+    passed a function to call.
+    """
+    def _assert_recorded(self, check, func, args, kwargs):
+        recorder = QueryRecorder()
+        if func is None:
+            return self._recording(recorder, check)
+        with self._recording(recorder, check):
+            func(*args, **kwargs)
+
+    @contextmanager
+    def _recording(self, recorder, check):
+        with recorder:
+            yield recorder
+        check(recorder)
+
+    def assertNumMemoryQueries(self, num, func=None, *args, **kwargs):
+        """Check how many queries were run against the data store."""
+        def check(recorder):
+            executed = recorder.queries
+            self.assertEqual(executed, num, "%d queries executed against the data store, %d expected" % (executed, num))
+        return self._assert_recorded(check, func, args, kwargs)
+
+    def assertMaxRowsScanned(self, num, func=None, *args, **kwargs):
+        """Check that no more than `num` rows were looked at by queries."""
+        def check(recorder):
+            scanned = recorder.total('scanned')
+            self.assertTrue(scanned <= num, "%d rows scanned in the data store, no more than %d expected" % (scanned, num))
+        return self._assert_recorded(check, func, args, kwargs)
 
 
 class QuerySet(DjangoQuerySet):
@@ -197,6 +3110,42 @@ class QuerySet(DjangoQuerySet):
         self.query.create(obj)
         return obj
 
+    def get(self, *args, **kwargs):
+        """Like Django's get(), but stops looking once a second match turns up.
+
+        Prefetching is left to Django's get(), which does it with the rest of
+        the results.
+        """
+        if self._prefetch_related_lookups:
+            return super(QuerySet, self).get(*args, **kwargs)
+        clone = self.filter(*args, **kwargs)
+        matches = list(islice(clone.query.iterate(ordered=False), 2))
+        if len(matches) == 1:
+            return matches[0]
+        if not matches:
+            raise self.model.DoesNotExist(
+                "%s matching query does not exist." %
+                self.model._meta.object_name)
+        raise self.model.MultipleObjectsReturned(
+            "get() returned more than one %s!" %
+            self.model._meta.object_name)
+
+    def bulk_create(self, objs, batch_size=None):
+        """Create a batch of objects in one go, setting their PKs."""
+        objs = list(objs)
+        if self.model._meta.parents:
+            raise ValueError("Can't bulk create an inherited model")
+        self.query.bulk_create(objs)
+        return objs
+
+    def in_bulk(self, id_list):
+        """Like Django's in_bulk(), reading unfiltered querysets from the table."""
+        if not id_list:
+            return {}
+        if self.query.where or self.query.is_empty():
+            return dict((obj.pk, obj) for obj in self.filter(pk__in=id_list).order_by())
+        return self.query.in_bulk(id_list)
+
     def get_or_create(self, **kwargs):
         try:
             return self.get(**kwargs), False
@@ -210,34 +3159,299 @@ class QuerySet(DjangoQuerySet):
         return self.query.update(**kwargs)
 
     def _update(self, values):
-        return True
+        """Called by Model.save() with a list of (field, model, value)."""
+        return self.query.update(**dict(
+            (field.attname, value) for field, model, value in values
+        ))
 
     def iterator(self):
-        return iter(self.query.execute())
+        return self.query.results()
+
+    def values(self, *fields):
+        return self._clone(klass=ValuesQuerySet, setup=True, _fields=fields, _kind='dict')
+
+    def values_list(self, *fields, **kwargs):
+        flat = kwargs.pop('flat', False)
+        if kwargs:
+            raise TypeError('Unexpected keyword arguments to values_list: %s' % (list(kwargs),))
+        if flat and len(fields) > 1:
+            raise TypeError("'flat' is not valid when values_list is called with more than one field.")
+        return self._clone(klass=ValuesQuerySet, setup=True, _fields=fields, _kind='flat' if flat else 'tuple')
+
+    def _setup_aggregate_query(self, aggregates):
+        """Annotated rows are each a group of their own, so nothing to do."""
+
+    def _prefetch_related_objects(self):
+        prefetch_related_objects(self._result_cache, self._prefetch_related_lookups)
+        self._prefetch_done = True
+
+
+class ValuesQuerySet(QuerySet):
+    """The results of values() and values_list(), made from the stored rows.
+
+    Django's own version builds up SQL columns to select. We only need the
+    names to project, and `_kind` to say which shape they come out in.
+    """
+    _kind = 'dict'
+
+    def _clone(self, klass=None, setup=False, **kwargs):
+        for name in ('_fields', '_kind', 'field_names', 'aggregate_names'):
+            kwargs.setdefault(name, getattr(self, name))
+        return super(ValuesQuerySet, self)._clone(klass, setup, **kwargs)
+
+    def _setup_query(self):
+        annotations = [alias for alias, (aggregate, is_summary) in self.query.aggregates.items() if not is_summary]
+        if self._fields:
+            self.field_names = [name for name in self._fields if name not in annotations]
+            self.aggregate_names = [name for name in self._fields if name in annotations]
+        else:
+            self.field_names = [field.attname for field in self.model._meta.concrete_fields]
+            self.aggregate_names = annotations
+        self._set_projection()
+
+    def _set_projection(self):
+        names = list(self._fields or self.field_names)
+        names.extend(name for name in self.aggregate_names if name not in names)
+        self.query.set_projection(names, self._kind)
+
+    def _setup_aggregate_query(self, aggregates):
+        """Annotating values() groups the rows by the fields selected."""
+        self.query.group_by = list(self.field_names)
+        self.aggregate_names.extend(aggregates)
+        self._set_projection()
 
 
 def get_related_queryset(self):
-    """Related querysets are defined funny."""
+    """Related querysets are defined funny.
+
+    The core filters are on the foreign key or many to many relation, so
+    they are answered by its index rather than a scan. Anything found by
+    prefetch_related() is used instead while it is still current.
+    """
+    prefetched = get_prefetched(self)
+    if prefetched is not None:
+        return prefetched
     return QuerySet(self.model).filter(**self.core_filters)
 
 
+def manager_relation(manager):
+    """Get the relation a ManyRelatedManager works on."""
+    if manager.reverse:
+        return get_relation(manager.through, manager.target_field_name)
+    return get_relation(manager.through, manager.source_field_name)
+
+
 def add_items(self, source_field_name, target_field_name, *objs):
-    """Descriptor method we can attach to the generated RelatedObjectQuerySets."""
-    data_store.setdefault((self.model, self.query_field_name), {})
-    store = data_store[(self.model, self.query_field_name)]
-    store.setdefault(self.instance.id, [])
-    store[self.instance.id] += objs
+    """Descriptor method we can attach to the generated RelatedObjectQuerySets.
+
+    The instance goes in the `source_field_name` column of the through table,
+    which is the source side of the relation unless this is the second half
+    of adding to a symmetrical relation.
+    """
+    relation = manager_relation(self)
+    pks = [obj.pk if isinstance(obj, Model) else obj for obj in objs]
+    if source_field_name == relation.source_name:
+        for pk in pks:
+            relation.add(self._fk_val, pk)
+    else:
+        for pk in pks:
+            relation.add(pk, self._fk_val)
 
 
 def remove_items(self, source_field_name, target_field_name, *objs):
     """Descriptor method we can attach to the generated RelatedObjectQuerySets."""
-    data_store.setdefault((self.model, self.query_field_name), {})
-    store = data_store[(self.model, self.query_field_name)]
-    store.setdefault(self.instance.id, [])
-    for o in objs:
-        store[self.instance.id].remove(o)
+    relation = manager_relation(self)
+    pks = [obj.pk if isinstance(obj, Model) else obj for obj in objs]
+    if source_field_name == relation.source_name:
+        for pk in pks:
+            relation.remove(self._fk_val, pk)
+    else:
+        for pk in pks:
+            relation.remove(pk, self._fk_val)
 
 
 def clear_items(self, source_field_name):
     """Descriptor method we can attach to the generated RelatedObjectQuerySets."""
-    data_store[(self.model, self.query_field_name)] = {}
+    relation = manager_relation(self)
+    relation.clear(self._fk_val, forward=source_field_name == relation.source_name)
+
+
+def model_queryset(model):
+    """Make a stand in `get_queryset` which always returns a QuerySet of `model`."""
+    def get_queryset(*args, **kwargs):
+        return QuerySet(model)
+    return get_queryset
+
+
+def related_models(model):
+    """Find the models directly related to `model`, in either direction."""
+    opts = model._meta
+    for field in opts.fields + opts.many_to_many:
+        if field.rel:
+            yield field.rel.to
+    for related in opts.get_all_related_objects() + opts.get_all_related_many_to_many_objects():
+        yield related.model
+
+
+def find_patches(model):
+    """Find everything on a model which needs redirecting to the data store.
+
+    Yields (target, attribute, replacement) for each of the model's managers,
+    the descriptors of its foreign keys and one-to-one fields, and the
+    managers generated for its reverse foreign keys and many to many fields
+    in both directions.
+    """
+    opts = model._meta
+    managers = set([model._default_manager, model._base_manager])
+    for _, name, manager in opts.concrete_managers + opts.abstract_managers:
+        managers.add(getattr(model, name))
+    for manager in managers:
+        yield manager, 'get_queryset', model_queryset(model)
+    for field in opts.fields:
+        if field.rel:
+            yield getattr(model, field.name), 'get_queryset', model_queryset(field.rel.to)
+    for related in opts.get_all_related_objects():
+        descriptor = getattr(model, related.get_accessor_name())
+        if hasattr(descriptor, 'related_manager_cls'):
+            yield descriptor.related_manager_cls, 'get_queryset', get_related_queryset
+        else:
+            yield descriptor, 'get_queryset', model_queryset(related.model)
+    m2m_descriptors = [getattr(model, field.name) for field in opts.many_to_many]
+    m2m_descriptors += [
+        getattr(model, related.get_accessor_name())
+        for related in opts.get_all_related_many_to_many_objects()
+    ]
+    for descriptor in m2m_descriptors:
+        manager_cls = descriptor.related_manager_cls
+        yield manager_cls, 'get_queryset', get_related_queryset
+        yield manager_cls, '_add_items', add_items
+        yield manager_cls, '_remove_items', remove_items
+        yield manager_cls, '_clear_items', clear_items
+
+
+patch_plans = {}
+
+
+def get_patch_plan(modules):
+    """Work out everything which needs patching for models used in `modules`.
+
+    Models found in the modules are followed through their relations to any
+    other models they can reach. The plan is only worked out once for each
+    set of modules.
+    """
+    try:
+        return patch_plans[modules]
+    except KeyError:
+        pass
+    pending = []
+    for name in modules:
+        module = import_module(name)
+        for value in vars(module).values():
+            if isinstance(value, type) and issubclass(value, Model) and not value._meta.abstract:
+                pending.append(value)
+    models = set()
+    while pending:
+        model = pending.pop()
+        if model not in models:
+            models.add(model)
+            pending.extend(related_models(model))
+    plan = patch_plans[modules] = []
+    seen = set()
+    for model in models:
+        for target, attribute, replacement in find_patches(model):
+            if (id(target), attribute) not in seen:
+                seen.add((id(target), attribute))
+                plan.append((target, attribute, replacement))
+    return plan
+
+
+MISSING = object()
+
+
+class Patcher(object):
+    """Applies a patch plan, and puts everything back afterwards.
+
+    Starting and stopping can be nested, only the outermost pair does
+    anything.
+    """
+    def __init__(self, modules):
+        self.modules = modules
+        self.depth = 0
+        self.originals = []
+
+    def start(self):
+        self.depth += 1
+        if self.depth > 1:
+            return
+        for target, attribute, replacement in get_patch_plan(self.modules):
+            self.originals.append((target, attribute, target.__dict__.get(attribute, MISSING)))
+            setattr(target, attribute, replacement)
+
+    def stop(self):
+        self.depth -= 1
+        if self.depth:
+            return
+        for target, attribute, original in reversed(self.originals):
+            if original is MISSING:
+                delattr(target, attribute)
+            else:
+                setattr(target, attribute, original)
+        self.originals = []
+
+
+def test_db(*modules):
+    """Decorator to run tests against the data store.
+
+    The models used in `modules` (and any models related to them) are
+    patched to use the data store. Test case classes are patched for the
+    whole class, from `setUpClass` to `tearDownClass`, so there's no cost
+    per test. Functions are patched for each call.
+
+    Setting the environment variable USE_REAL_DB=1 turns this off.
+    """
+    def decorator(obj):
+        if os.environ.get('USE_REAL_DB', '0') != '0':
+            return obj
+        patcher = Patcher(modules)
+        if isinstance(obj, type):
+            return patch_test_case(obj, patcher)
+
+        @wraps(obj)
+        def wrapper(*args, **kwargs):
+            patcher.start()
+            try:
+                return obj(*args, **kwargs)
+            finally:
+                patcher.stop()
+        return wrapper
+    return decorator
+
+
+def patch_test_case(cls, patcher):
+    """Wrap setUpClass and tearDownClass on `cls` to start and stop patching."""
+    set_up = cls.__dict__.get('setUpClass')
+    tear_down = cls.__dict__.get('tearDownClass')
+
+    def setUpClass(klass):
+        patcher.start()
+        try:
+            if set_up is not None:
+                set_up.__get__(None, klass)()
+            else:
+                super(cls, klass).setUpClass()
+        except Exception:
+            patcher.stop()
+            raise
+
+    def tearDownClass(klass):
+        try:
+            if tear_down is not None:
+                tear_down.__get__(None, klass)()
+            else:
+                super(cls, klass).tearDownClass()
+        finally:
+            patcher.stop()
+
+    cls.setUpClass = classmethod(setUpClass)
+    cls.tearDownClass = classmethod(tearDownClass)
+    return cls